@@ -0,0 +1,66 @@
+import copy
+import time
+
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
+
+from layers import BinaryDecorator, binarize_model, compile_inference
+
+
+def time_forward(model: nn.Module, images: Variable, n_repeat: int) -> float:
+    """
+    :return: average forward pass duration, sec
+    """
+    model(images)  # warm-up
+    start = time.time()
+    for repeat in range(n_repeat):
+        model(images)
+    return (time.time() - start) / n_repeat
+
+
+def benchmark_packed_inference(fc_sizes=(784, 50, 10), batch_size=256, n_repeat=50, batch_norm=False):
+    """
+    Compares the weight memory and the speed of float and bit-packed XNOR/popcount inference
+    of a compiled binary fully connected net. The packed model is a compact format and is not expected
+    to be faster than the float BLAS matmul on wide layers.
+    :param batch_norm: add BatchNorm after hidden layers (folded into the input thresholds of the next layers)
+    """
+    fc_layers = []
+    for in_features, out_features in zip(fc_sizes[:-1], fc_sizes[1:]):
+        fc_layers.append(nn.Linear(in_features, out_features, bias=False))
+        if batch_norm and len(fc_layers) < 2 * (len(fc_sizes) - 2):
+            bn = nn.BatchNorm1d(out_features)
+            bn.running_mean.normal_(std=in_features ** 0.5)
+            bn.running_var.uniform_(0.5 * in_features, 2 * in_features)
+            bn.weight.data.normal_()
+            bn.bias.data.normal_()
+            fc_layers.append(bn)
+    model_float = binarize_model(nn.Sequential(*fc_layers))
+    model_float.eval()
+    compile_inference(model_float)
+    model_packed = copy.deepcopy(model_float)
+    compile_inference(model_packed, packed=True)
+    print(model_packed)
+
+    images = Variable(torch.randn(batch_size, fc_sizes[0]), volatile=True)
+    outputs_float = model_float(images).data
+    outputs_packed = model_packed(images).data
+    assert torch.equal(outputs_float, outputs_packed), "Packed outputs differ from the float path"
+
+    layers_packed = [layer for layer in model_packed.children() if isinstance(layer, BinaryDecorator)]
+    bytes_float = sum(layer.layer.weight.data.numel() * 4 for layer in layers_packed)
+    bytes_packed = sum(layer.weight_packed.nbytes for layer in layers_packed)
+    duration_float = time_forward(model_float, images, n_repeat=n_repeat)
+    duration_packed = time_forward(model_packed, images, n_repeat=n_repeat)
+    print(f"Net {fc_sizes}, batch norm {batch_norm}, batch size {batch_size}")
+    print(f"Weights memory: float {bytes_float} B, packed {bytes_packed} B "
+          f"({bytes_float / bytes_packed:.1f}x less)")
+    print(f"Forward: float {duration_float * 1e3:.3f} ms, packed {duration_packed * 1e3:.3f} ms "
+          f"({duration_float / duration_packed:.2f}x speedup)")
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(1)
+    benchmark_packed_inference()
+    benchmark_packed_inference(fc_sizes=(784, 256, 256, 10), batch_norm=True)
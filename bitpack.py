@@ -0,0 +1,170 @@
+import numpy as np
+import torch
+
+WORD_BITS = 64
+
+# SWAR popcount masks
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def n_words(n_bits: int) -> int:
+    return (n_bits + WORD_BITS - 1) // WORD_BITS
+
+
+def bytes_to_words(packed_bytes: np.ndarray) -> np.ndarray:
+    """
+    :param packed_bytes: (N, n_bytes) uint8 array of bits, packed by np.packbits along the last axis
+    :return: (N, n_words) uint64 array; the tail of the last word is padded with zero bits
+    """
+    n_rows, n_bytes = packed_bytes.shape
+    words = np.zeros((n_rows, n_words(8 * n_bytes) * 8), dtype=np.uint8)
+    words[:, :n_bytes] = packed_bytes
+    return words.view(np.uint64)
+
+
+def pack_signs(tensor: torch.FloatTensor) -> np.ndarray:
+    """
+    Packs signs of a 2D tensor: positive values are encoded as bit 1, the rest as bit 0 (same rule as BinaryFunc).
+    :param tensor: (N, F) tensor
+    :return: (N, ceil(F / 64)) uint64 array
+    """
+    bits = (tensor > 0).cpu().numpy()
+    return bytes_to_words(np.packbits(bits, axis=-1))
+
+
+def pack_signs_bytes(tensor: torch.FloatTensor) -> torch.ByteTensor:
+    """
+    :param tensor: (N, F) tensor
+    :return: (N, ceil(F / 64) * 8) ByteTensor: the uint64 words of pack_signs, viewed as bytes,
+             so that they can be stored and batched as a regular tensor
+    """
+    return torch.from_numpy(pack_signs(tensor).view(np.uint8))
+
+
+def bytes_tensor_to_words(tensor: torch.ByteTensor) -> np.ndarray:
+    """
+    :param tensor: (N, n_words * 8) ByteTensor, created by pack_signs_bytes
+    :return: (N, n_words) uint64 array
+    """
+    return np.ascontiguousarray(tensor.cpu().numpy()).view(np.uint64)
+
+
+def is_packed_signs(tensor) -> bool:
+    return tensor.type() in ('torch.ByteTensor', 'torch.cuda.ByteTensor')
+
+
+def is_integer(tensor) -> bool:
+    return tensor.type() == 'torch.IntTensor'
+
+
+def pack_thresholded(x: np.ndarray, threshold: np.ndarray = None, invert: np.ndarray = None) -> np.ndarray:
+    """
+    Packs the bits (x > threshold) XOR invert of integer inputs with integer ops only.
+    :param x: (N, F) int32 array, e.g. pre-activations of a packed binary layer
+    :param threshold: (F,) int32 array of per-feature thresholds; 0 if not set
+    :param invert: (F,) bool array of the features with inverted bits
+    :return: (N, n_words) uint64 array
+    """
+    if threshold is None:
+        return bytes_to_words(np.packbits(x > 0, axis=-1))
+    return bytes_to_words(np.packbits(np.bitwise_xor(x > threshold, invert), axis=-1))
+
+
+def unpack_signs(words: np.ndarray, n_bits: int) -> torch.FloatTensor:
+    """
+    :param words: (N, n_words) uint64 array, created by pack_signs
+    :param n_bits: number of valid bits in each row
+    :return: (N, n_bits) tensor of +1 and -1
+    """
+    bits = np.unpackbits(words.view(np.uint8), axis=-1)[:, :n_bits]
+    signs = bits.astype(np.float32) * 2 - 1
+    return torch.from_numpy(signs)
+
+
+def bit_count(words: np.ndarray) -> np.ndarray:
+    """
+    :param words: uint64 array
+    :return: number of set bits of each word
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    v = words - ((words >> np.uint64(1)) & _M1)
+    v = (v & _M2) + ((v >> np.uint64(2)) & _M2)
+    v = (v + (v >> np.uint64(4))) & _M4
+    return (v * _H01) >> np.uint64(56)
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """
+    :param words: uint64 array
+    :return: number of set bits, summed along the last axis
+    """
+    return bit_count(words).sum(axis=-1, dtype=np.int32)
+
+
+def xnor_linear(x_words: np.ndarray, weight_words: np.ndarray, n_bits: int) -> np.ndarray:
+    """
+    Binary linear layer: dot product of two +1/-1 vectors of length `n_bits` equals
+    popcount(XNOR) - popcount(XOR) = n_bits - 2 * popcount(XOR).
+    Padding bits are zeros in both operands and never contribute to XOR.
+    Mismatches are accumulated word by word, so only (N, out_features) temporaries are created.
+    :param x_words: (N, n_words) packed input signs
+    :param weight_words: (out_features, n_words) packed weight signs
+    :param n_bits: in_features
+    :return: (N, out_features) int32 array of pre-activations
+    """
+    x_columns = np.ascontiguousarray(x_words.T)
+    weight_columns = np.ascontiguousarray(weight_words.T)
+    mismatches = np.zeros((x_words.shape[0], weight_words.shape[0]), dtype=np.int32)
+    for x_word, weight_word in zip(x_columns, weight_columns):
+        mismatches += bit_count(np.bitwise_xor(x_word[:, np.newaxis], weight_word[np.newaxis, :]))
+    return n_bits - 2 * mismatches
+
+
+class PackedBits(object):
+    """
+    Signs of a binary (+1/-1) tensor, packed into uint64 words (1 bit per element, same rule as BinaryFunc).
+    Zero elements can't be packed and raise ValueError.
+    """
+
+    def __init__(self, tensor: torch.FloatTensor):
+        self.shape = tensor.shape
+        self.n_bits = tensor.numel()
+        self.words = self.pack_binary(tensor)
+
+    @staticmethod
+    def pack_binary(tensor: torch.FloatTensor) -> np.ndarray:
+        if (tensor == 0).any():
+            raise ValueError("Zero elements can't be packed as signs; binarize the tensor first")
+        return pack_signs(tensor.view(1, -1))[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.words.nbytes
+
+    def pack(self, tensor: torch.FloatTensor):
+        """
+        Overwrites the stored signs with the signs of the tensor.
+        """
+        self.words[:] = self.pack_binary(tensor)
+
+    def flip(self, indices: torch.LongTensor):
+        """
+        Flips the stored signs of the elements at the flat (distinct) indices.
+        """
+        indices = indices.cpu().numpy()
+        bit_masks = np.right_shift(0x80, indices & 7).astype(np.uint8)
+        # several indices may fall into the same byte
+        np.bitwise_xor.at(self.words.view(np.uint8), indices >> 3, bit_masks)
+
+    def unpack(self) -> torch.FloatTensor:
+        """
+        :return: tensor of +1 and -1 of the original shape
+        """
+        return unpack_signs(self.words[np.newaxis, :], self.n_bits).view(self.shape)
+
+    def unpack_into(self, tensor: torch.FloatTensor):
+        tensor.copy_(self.unpack())
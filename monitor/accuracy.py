@@ -3,7 +3,7 @@ import torch.nn as nn
 import torch.utils.data
 from torch.autograd import Variable
 
-from utils import get_data_loader
+from utils import get_data_loader, ResidentLoader
 
 
 def argmax_accuracy(outputs, labels) -> float:
@@ -18,6 +18,10 @@ def get_outputs(model: nn.Module, loader: torch.utils.data.DataLoader):
     use_cuda = torch.cuda.is_available()
     if use_cuda:
         model.cuda()
+    if isinstance(loader, ResidentLoader):
+        outputs_full, labels_full = get_outputs_resident(model, loader, use_cuda=use_cuda)
+        model.train(mode_saved)
+        return outputs_full, labels_full
     outputs_full = []
     labels_full = []
     for inputs, labels in iter(loader):
@@ -34,6 +38,24 @@ def get_outputs(model: nn.Module, loader: torch.utils.data.DataLoader):
     return outputs_full, labels_full
 
 
+def get_outputs_resident(model: nn.Module, loader: ResidentLoader, use_cuda=False):
+    """
+    Runs the resident set through the model chunk by chunk, writing into the loader's outputs buffer.
+    The returned outputs are overwritten by the next call.
+    """
+    if use_cuda and not loader.images.is_cuda:
+        loader.cuda()
+    outputs_full = None
+    position = 0
+    for inputs, labels in iter(loader):
+        outputs = model(Variable(inputs, volatile=True)).data
+        if outputs_full is None:
+            outputs_full = loader.output_buffer(outputs)
+        outputs_full[position: position + len(outputs)].copy_(outputs)
+        position += len(outputs)
+    return Variable(outputs_full, volatile=True), Variable(loader.labels, volatile=True)
+
+
 def calc_accuracy(model: nn.Module, loader: torch.utils.data.DataLoader) -> float:
     if model is None:
         return 0.0
@@ -20,7 +20,9 @@ class Autocorrelation(object):
         self.with_autocorrelation = with_autocorrelation
         self.with_cross_correlation = with_cross_correlation
         deque_length = max(100, 5 * self.n_lags)
-        self.samples = defaultdict(lambda: deque(maxlen=deque_length))
+        self.samples = defaultdict(lambda: deque(maxlen=deque_length))  # flat indices, flipped at each step
+        self.latest = {}  # the most recent parameter state
+        self.params = {}
 
     def add_samples(self, param_flips: Iterable):
         """
@@ -28,7 +30,36 @@ class Autocorrelation(object):
         """
         if self.with_autocorrelation:
             for pflip in param_flips:
-                self.samples[pflip.name].append(pflip.param.data.cpu().view(-1))
+                if self.params.get(pflip.name, None) is not pflip.param:
+                    # new or swapped parameter: start a new history
+                    self.params[pflip.name] = pflip.param
+                    self.latest[pflip.name] = pflip.param.data.cpu().view(-1).clone()
+                    self.samples[pflip.name].clear()
+                    self.samples[pflip.name].append(None)
+                elif pflip.is_flipped:
+                    idx_flipped = pflip.get_idx_flipped().cpu()
+                    latest = self.latest[pflip.name]
+                    latest.index_copy_(0, idx_flipped, latest.index_select(0, idx_flipped).neg_())
+                    self.samples[pflip.name].append(idx_flipped)
+                else:
+                    # rejected
+                    self.samples[pflip.name].append(None)
+
+    def get_observations(self, name: str) -> torch.FloatTensor:
+        """
+        Restores the parameter history by undoing the flips, starting from the latest state.
+        :param name: parameter name
+        :return: (n_samples, n_elements) parameter states
+        """
+        state = self.latest[name]
+        observations = [state]
+        for idx_flipped in reversed(list(self.samples[name])[1:]):
+            if idx_flipped is not None:
+                state = state.clone()
+                state.index_copy_(0, idx_flipped, state.index_select(0, idx_flipped).neg_())
+            observations.append(state)
+        observations.reverse()
+        return torch.stack(observations, dim=0)
 
     @Schedule(epoch_update=10)
     def plot(self, viz: visdom.Visdom):
@@ -45,7 +76,7 @@ class Autocorrelation(object):
         for name, samples in self.samples.items():
             if len(samples) < self.n_lags + 1:
                 continue
-            observations = torch.stack(samples, dim=0)
+            observations = self.get_observations(name)
             observations.t_()
             observations = observations.numpy()
             active_rows_mask = list(map(np.any, np.diff(observations, axis=1)))
@@ -73,7 +73,7 @@ class GraphMCMC(object):
                                                    f"Did you forget to pass it in the constructor?"
             pnode = self.param_nodes[pflip.name]
             if pnode.idx_flipped is not None:
-                pnode.idx_flipped += pflip.get_idx_flipped().cpu().numpy()
+                pnode.idx_flipped.reshape(-1)[pflip.get_idx_flipped().cpu().numpy()] += 1
         self.save_sample_activations(param_flips)
 
     @Schedule(epoch_update=0, batch_update=1)
@@ -85,7 +85,8 @@ class GraphMCMC(object):
             # clear old activations
             pnode.save_activations(new_source=[], new_sink=[])
         for pflip in param_flips:
-            self.param_nodes[pflip.name].save_activations(new_source=pflip.source, new_sink=pflip.sink)
+            self.param_nodes[pflip.name].save_activations(new_source=pflip.source.cpu().tolist(),
+                                                          new_sink=pflip.sink.cpu().tolist())
 
     @staticmethod
     def neuron_name(layer_name: str, neuron_id: int):
@@ -14,7 +14,8 @@ from monitor.mutual_info.mutual_info import MutualInfoKMeans, MutualInfoSign, Mu
 from monitor.var_online import VarianceOnline
 from monitor.viz import VisdomMighty
 from monitor.accuracy import calc_accuracy
-from utils import named_parameters_binary, parameters_binary, MNISTSmall, get_data_loader, factors_root
+from utils import named_parameters_binary, param_shape_2d, parameters_binary, MNISTSmall, get_data_loader, \
+    factors_root, ResidentLoader
 
 
 def timer_profile(func):
@@ -130,7 +131,8 @@ class Monitor(object):
         self.viz = VisdomMighty(env=f"{time.strftime('%Y-%b-%d')} "
                                     f"{trainer.dataset_name} "
                                     f"{trainer.__class__.__name__}", timer=self.timer, send=is_active)
-        self.test_loader = get_data_loader(dataset=trainer.dataset_name, train=False)
+        self.test_loader = ResidentLoader(get_data_loader(dataset=trainer.dataset_name, train=False,
+                                                          **dict(trainer.loader_kwargs, shuffle=False)))
         self.param_records = ParamsDict()
         self.mutual_info = MutualInfoKMeans(estimate_size=int(1e3), compression_range=(0.5, 0.999))
         self.functions = []
@@ -194,6 +196,9 @@ class Monitor(object):
     def register_func(self, func: Callable, opts: dict = None):
         self.functions.append((func, opts))
 
+    def mcmc_step(self, param_flips):
+        pass
+
     def update_distribution(self):
         for name, param_record in self.param_records.items():
             param = param_record.param
@@ -336,7 +341,8 @@ class MonitorMCMC(Monitor):
         self.autocorrelation = Autocorrelation(n_lags=self.timer.batches_in_epoch,
                                                with_autocorrelation=isinstance(trainer.train_loader.dataset,
                                                                                MNISTSmall))
-        named_param_shapes = iter((name, param.shape) for name, param in named_parameters_binary(trainer.model))
+        named_param_shapes = iter((name, param_shape_2d(param))
+                                  for name, param in named_parameters_binary(trainer.model))
         self.graph_mcmc = GraphMCMC(named_param_shapes=named_param_shapes, timer=self.timer,
                                     history_heatmap=True)
 
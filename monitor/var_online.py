@@ -11,36 +11,76 @@ class VarianceOnline(object):
 
     """
     Online updating sample mean and unbiased variance in a single pass.
+    Batches are merged with the parallel algorithm of Chan et al. into float64 (count, mean, M2) accumulators,
+    so partial statistics (e.g. of several DataLoader workers) can be combined with merge().
     """
 
     def __init__(self, tensor: torch.FloatTensor = None, is_active=False):
         self.mean = None
-        self.var = None
+        self.m2 = None
         self.count = 0
+        self.tensor_type = None
         self.is_active = is_active
         if tensor is not None:
             self.update(new_tensor=tensor)
 
     def update(self, new_tensor: torch.FloatTensor):
+        """
+        :param new_tensor: a single sample
+        """
+        self.update_batch(new_tensor.unsqueeze(0))
+
+    def update_batch(self, batch: torch.FloatTensor):
+        """
+        :param batch: samples, stacked along the first dimension
+        """
         if not self.is_active:
             return
-        self.count += 1
+        self.tensor_type = batch.type()
+        batch = batch.double()
+        mean = batch.mean(dim=0)
+        m2 = (batch - mean.unsqueeze(0)).pow_(2).sum(dim=0)
+        self.merge_stats(count=batch.shape[0], mean=mean, m2=m2)
+
+    def merge_stats(self, count: int, mean: torch.DoubleTensor, m2: torch.DoubleTensor):
+        """
+        Merges partial statistics in place.
+        :param count: number of samples
+        :param mean: sample mean
+        :param m2: sum of squared deviations from the mean
+        """
+        if count == 0:
+            return
         if self.mean is None:
-            self.mean = new_tensor.clone()
-            self.var = torch.zeros_like(self.mean)
-        else:
-            self.var = (self.count - 2) / (self.count - 1) * self.var + torch.pow(new_tensor - self.mean, 2) / self.count
-            self.mean += (new_tensor - self.mean) / self.count
+            self.count = count
+            self.mean = mean.clone()
+            self.m2 = m2.clone()
+            return
+        count_total = self.count + count
+        delta = mean - self.mean
+        self.mean.add_(delta * (count / count_total))
+        self.m2.add_(m2).add_(delta.pow_(2) * (self.count * count / count_total))
+        self.count = count_total
+
+    def merge(self, other: 'VarianceOnline'):
+        """
+        Merges the statistics of another instance in place.
+        """
+        if other.mean is None:
+            return
+        self.tensor_type = other.tensor_type
+        self.merge_stats(count=other.count, mean=other.mean, m2=other.m2)
 
     def get_mean_std(self):
         if self.mean is None:
             return None, None
         else:
-            return self.mean.clone(), torch.sqrt(self.var)
+            var = self.m2 / max(self.count - 1, 1)
+            return self.mean.type(self.tensor_type), torch.sqrt(var).type(self.tensor_type)
 
     def reset(self):
         self.mean = None
-        self.var = None
+        self.m2 = None
         self.count = 0
 
     def set_active(self, is_active: bool):
@@ -63,8 +103,7 @@ def dataset_mean_std(dataset_cls: type, batch_size=256):
         loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=4)
         var_online = VarianceOnline(is_active=True)
         for images, labels in tqdm(loader, desc=f"{dataset_cls.__name__}: running online mean, std"):
-            for image in images:
-                var_online.update(new_tensor=image)
+            var_online.update_batch(images)
         mean, std = var_online.get_mean_std()
         mean_std_file.parent.mkdir(exist_ok=True, parents=True)
         with open(mean_std_file, 'wb') as f:
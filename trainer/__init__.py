@@ -1,4 +1,6 @@
 from trainer.gradient import TrainerGradFullPrecision, TrainerGradBinary
-from trainer.mcmc import TrainerMCMC, TrainerMCMCTree, TrainerMCMCGibbs
-from trainer.tempering import ParallelTempering
-
+from trainer.mcmc import TrainerMCMC, TrainerMCMCTree, TrainerMCMCGibbs, TrainerMCMCHeatBath, TrainerMCMCAusterity, \
+    TrainerMCMCGradient, TrainerMCMCMultipleTry, TrainerMCMCFullData, TrainerMCMCMargin
+from trainer.tempering import ParallelTempering, ParallelTemperingVectorized, ParallelTemperingProcesses, \
+    ParallelTemperingPacked
+from trainer.annealing import PopulationAnnealing
@@ -0,0 +1,89 @@
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
+
+from layers import compile_inference
+from trainer.mcmc import TrainerMCMCGibbs
+from trainer.replicas import ReplicaEngine
+from trainer.tempering import flip_ratio_ladder
+from trainer.trainer import Trainer
+
+
+class PopulationAnnealing(Trainer):
+    """
+    Population annealing (sequential Monte Carlo): a large population of replicas, stored and evaluated
+    in a ReplicaEngine, is cooled along a geometric flip ratio (temperature) schedule.
+    At each temperature step the population is resampled with importance weights exp(-(beta_new - beta_old) * E),
+    beta = 1 / flip_ratio, by copying weight rows in place; then every replica makes `n_sweeps` MCMC steps
+    at the new temperature. Once the schedule is over, the population keeps sampling at the coldest temperature.
+    """
+
+    def __init__(self, model: nn.Module, criterion: nn.Module, dataset_name: str, trainer_cls=TrainerMCMCGibbs,
+                 n_replicas=256, n_temperatures=1000, n_sweeps=5, flip_min=0.001, flip_max=0.9, **kwargs):
+        """
+        :param trainer_cls: MCMC trainer class whose accept_vector() is used in the sweeps
+        :param n_replicas: population size
+        :param n_temperatures: number of temperature steps (batches) from flip_max down to flip_min
+        :param n_sweeps: MCMC steps of each replica per temperature step
+        :param flip_min: final flip ratio (temperature)
+        :param flip_max: initial flip ratio (temperature)
+        """
+        compile_inference(model, keep_batch_norm=True)
+        super().__init__(model=model, criterion=criterion, dataset_name=dataset_name, **kwargs)
+        self.trainer_cls = trainer_cls
+        self.n_replicas = n_replicas
+        self.n_sweeps = n_sweeps
+        self.flip_ratios = flip_ratio_ladder(n_temperatures, flip_min=flip_min, flip_max=flip_max)[::-1]
+        self.temperature_id = 0
+        self.effective_size = n_replicas
+        self.engine = ReplicaEngine(model, criterion=criterion, n_replicas=n_replicas)
+        self.monitor.log(f"Population annealing of {n_replicas} replicas, MCMC acceptance: {trainer_cls.__name__}, "
+                         f"{n_sweeps} sweeps per temperature step")
+        self.monitor.log(f"Flip ratio schedule: {flip_max} -> {flip_min} in {n_temperatures} steps")
+        self._monitor_functions()
+
+    @property
+    def flip_ratio(self) -> float:
+        return self.flip_ratios[self.temperature_id]
+
+    def resample(self, losses: torch.FloatTensor, beta_diff: float):
+        """
+        Resamples the population with importance weights exp(-beta_diff * E).
+        :param losses: loss (energy) of each replica
+        :param beta_diff: increase of the inverse temperature
+        """
+        log_weights = -beta_diff * (losses - losses.min())
+        weights = torch.exp(log_weights)
+        self.effective_size = weights.sum() ** 2 / (weights ** 2).sum()
+        indices = torch.multinomial(weights, num_samples=self.n_replicas, replacement=True)
+        self.engine.resample(indices)
+
+    def train_batch(self, images, labels):
+        if len(self.engine.weights) == 0:
+            self.engine.init(images)
+        elif self.temperature_id < len(self.flip_ratios) - 1:
+            flip_ratio_prev = self.flip_ratio
+            self.temperature_id += 1
+            outputs = self.engine.forward(images, self.engine.weights)
+            losses = self.engine.losses(outputs, labels)
+            self.resample(losses, beta_diff=1 / self.flip_ratio - 1 / flip_ratio_prev)
+        flip_ratios = [self.flip_ratio] * self.n_replicas
+        for sweep in range(self.n_sweeps):
+            outputs, losses = self.engine.step(images, labels, flip_ratios=flip_ratios,
+                                               proba_accept=self.trainer_cls.accept_vector)
+        best_replica = min(range(self.n_replicas), key=lambda replica_id: losses[replica_id])
+        self.engine.load_replica(best_replica)
+        best_outputs = Variable(outputs[best_replica], volatile=True)
+        return best_outputs, self.criterion(best_outputs, labels)
+
+    def _monitor_functions(self):
+        self.monitor.register_func(lambda: self.flip_ratio * 100., opts=dict(
+            xlabel='Epoch',
+            ylabel='Sign flip ratio, %',
+            title='Population annealing flip_ratio'
+        ))
+        self.monitor.register_func(lambda: self.effective_size / self.n_replicas, opts=dict(
+            xlabel='Epoch',
+            ylabel='ESS / n_replicas',
+            title='Population annealing effective sample size'
+        ))
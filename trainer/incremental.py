@@ -0,0 +1,341 @@
+from collections import defaultdict
+from typing import Iterable
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+from bitpack import is_packed_signs
+from layers import BinaryDecorator
+
+
+def sign_binary(tensor: torch.FloatTensor) -> torch.FloatTensor:
+    """
+    Same rule as BinaryFunc: positive values become +1, the rest -1.
+    """
+    return 2 * (tensor > 0).type_as(tensor) - 1
+
+
+class _InputsCaptured(Exception):
+    pass
+
+
+class BinaryStage(object):
+    def __init__(self, name: str, decorator: BinaryDecorator):
+        """
+        :param name: binary weight name, as in model.named_parameters()
+        :param decorator: binary layer
+        """
+        self.name = name
+        self.decorator = decorator
+        self.post_modules = []  # modules, applied between this and the next binary layer
+
+    @property
+    def weight(self) -> torch.FloatTensor:
+        return self.decorator.layer.weight.data
+
+    @property
+    def is_conv(self) -> bool:
+        return isinstance(self.decorator.layer, nn.Conv2d)
+
+    def prepare_input(self, raw_input: torch.FloatTensor) -> torch.FloatTensor:
+        if is_packed_signs(raw_input):
+            return self.decorator.unpack_input(raw_input)
+        if not self.is_conv:
+            raw_input = raw_input.view(raw_input.shape[0], -1)
+        if self.decorator.input_threshold is not None:
+            # folded BatchNorm
+            raw_input = self.decorator.threshold_input(Variable(raw_input, volatile=True)).data
+        return sign_binary(raw_input)
+
+    def forward_layer(self, inputs: torch.FloatTensor, weight: torch.FloatTensor = None) -> torch.FloatTensor:
+        """
+        :param inputs: binary inputs
+        :param weight: weight to use instead of the layer's one
+        :return: pre-activations
+        """
+        if weight is None:
+            weight = self.weight
+        if not self.is_conv:
+            return torch.mm(inputs, weight.t())
+        layer = self.decorator.layer
+        outputs = F.conv2d(Variable(inputs, volatile=True), Variable(weight, volatile=True), None,
+                           stride=layer.stride, padding=layer.padding, dilation=layer.dilation)
+        return outputs.data
+
+    def forward_units(self, inputs: torch.FloatTensor, units: torch.LongTensor,
+                      weight: torch.FloatTensor = None) -> torch.FloatTensor:
+        """
+        :param inputs: inputs of the selected units only
+        :param units: input features (channels for conv layers)
+        :return: contribution of the selected input units to the pre-activations
+        """
+        if weight is None:
+            weight = self.weight
+        return self.forward_layer(inputs, weight.index_select(1, units))
+
+    def forward_flip(self, inputs: torch.FloatTensor, pflip) -> torch.FloatTensor:
+        """
+        :param inputs: binary inputs
+        :param pflip: applied ParameterFlip of this layer's weight
+        :return: delta of the pre-activations of the `pflip.sink` units
+        """
+        weight_delta = pflip.weight_delta()
+        if not self.is_conv:
+            return torch.mm(inputs.index_select(1, pflip.source), weight_delta.t())
+        # scatter the flipped (in_channel, kernel position) columns and keep the involved input channels only
+        out_channels, in_channels, kernel_height, kernel_width = self.weight.shape
+        kernel_size = kernel_height * kernel_width
+        weight_sink = weight_delta.new(len(pflip.sink), in_channels * kernel_size).zero_()
+        weight_sink.index_copy_(1, pflip.source, weight_delta)
+        weight_sink = weight_sink.view(-1, in_channels, kernel_height, kernel_width)
+        columns = weight_delta.new(in_channels * kernel_size).zero_()
+        columns.index_fill_(0, pflip.source, 1)
+        channels = columns.view(in_channels, kernel_size).sum(dim=1).nonzero().view(-1)
+        return self.forward_units(inputs.index_select(1, channels), channels, weight=weight_sink)
+
+    def changed_units(self, inputs_diff: torch.FloatTensor) -> torch.LongTensor:
+        """
+        :param inputs_diff: difference of the binary inputs
+        :return: input features (channels for conv layers) that changed in any sample
+        """
+        n_units = inputs_diff.shape[1]
+        diff = inputs_diff.abs().transpose(0, 1).contiguous().view(n_units, -1).sum(dim=1)
+        return (diff > 0).nonzero()
+
+    def forward_post(self, outputs: torch.FloatTensor) -> torch.FloatTensor:
+        if len(self.post_modules) == 0:
+            return outputs
+        x = Variable(outputs, volatile=True)
+        for module in self.post_modules:
+            x = module(x)
+        return x.data
+
+    def is_supported(self) -> bool:
+        layer = self.decorator.layer
+        if not isinstance(layer, nn.Linear) and not (isinstance(layer, nn.Conv2d) and layer.groups == 1):
+            return False
+        for module in self.post_modules:
+            if isinstance(module, nn.modules.batchnorm._BatchNorm) and module.training:
+                # mixes samples in a batch
+                return False
+        return True
+
+
+class IncrementalForward(object):
+    """
+    Caches per-layer binary inputs and pre-activations of the current batch and re-evaluates the model
+    after parameter flips by recomputing only the affected columns:
+        delta(outputs[:, sink]) = x_old[:, source] @ (W_new - W_old)[sink, source]^T,
+    followed by a sparse update of the next layer if any of its sign inputs changed.
+    Supported models are chains of BinaryDecorator(nn.Linear or nn.Conv2d) layers, separated by modules that
+    don't mix samples (BatchNorm must be in eval mode). Functional code before the first binary layer and
+    flattening between conv and linear layers are allowed. For conv layers, only the flipped output channels
+    are recomputed, and the next layer is updated from the changed input channels.
+    """
+
+    def __init__(self, model: nn.Module):
+        self.model = model
+        self.stages = []
+        self.stage_ids = {}
+        self.is_supported = None  # unknown until the first forward pass
+        self.inputs = []
+        self.outputs = []
+        self.result = None
+        self.pending = None
+
+    def parse(self, images: Variable):
+        decorator_names = {}
+        inner_modules = set()
+        for name, module in self.model.named_modules():
+            if isinstance(module, BinaryDecorator):
+                prefix = f"{name}.layer" if name else "layer"
+                decorator_names[module] = f"{prefix}.weight"
+                inner_modules.update(module.layer.modules())
+
+        call_order = []
+        handles = []
+        for module in self.model.modules():
+            is_leaf = len(list(module.children())) == 0
+            if module in decorator_names or (is_leaf and module not in inner_modules):
+                handles.append(module.register_forward_hook(lambda m, inputs, output: call_order.append(m)))
+        self.model(images)
+        for handle in handles:
+            handle.remove()
+
+        self.stages = []
+        for module in call_order:
+            if module in decorator_names:
+                self.stages.append(BinaryStage(name=decorator_names[module], decorator=module))
+            elif len(self.stages) > 0:
+                self.stages[-1].post_modules.append(module)
+        self.stage_ids = {stage.name: stage_id for stage_id, stage in enumerate(self.stages)}
+        self.is_supported = len(self.stages) > 0 and len(set(call_order)) == len(call_order) and \
+                            all(stage.is_supported() for stage in self.stages)
+        if self.is_supported:
+            self.is_supported = self.validate(images)
+
+    def validate(self, images: Variable) -> bool:
+        """
+        :return: whether a stage-by-stage evaluation reproduces the model outputs
+        """
+        outputs = self.forward(images)
+        # the cached inputs are already prepared
+        x = self.stages[0].forward_post(self.stages[0].forward_layer(self.inputs[0]))
+        for stage in self.stages[1:]:
+            x = stage.forward_post(stage.forward_layer(stage.prepare_input(x)))
+        diff = (x - outputs.data).abs().max()
+        return diff <= 1e-5 * (1 + outputs.data.abs().max())
+
+    def forward(self, images: Variable) -> Variable:
+        """
+        Full forward pass that caches the activations.
+        :param images: batch of input images
+        :return: model outputs
+        """
+        if self.is_supported is None:
+            self.parse(images)
+        if not self.is_supported:
+            return self.model(images)
+        captured = []
+
+        def capture(module, inputs, output):
+            captured.append((inputs[0].data, output.data))
+
+        handles = [stage.decorator.register_forward_hook(capture) for stage in self.stages]
+        outputs = self.model(images)
+        for handle in handles:
+            handle.remove()
+        self.inputs = [stage.prepare_input(inputs) for stage, (inputs, _) in zip(self.stages, captured)]
+        self.outputs = [stage_outputs for _, stage_outputs in captured]
+        self.result = outputs.data
+        self.pending = None
+        return outputs
+
+    def forward_inputs(self, images: Variable) -> torch.FloatTensor:
+        """
+        Runs the model only up to the first binary layer.
+        :param images: batch of input images
+        :return: binary inputs of the first binary layer
+        """
+        assert self.is_supported, "Run forward() first"
+        captured = []
+
+        def capture(module, inputs):
+            captured.append(inputs[0].data)
+            raise _InputsCaptured()
+
+        handle = self.stages[0].decorator.register_forward_pre_hook(capture)
+        try:
+            self.model(images)
+        except _InputsCaptured:
+            pass
+        finally:
+            handle.remove()
+        return self.stages[0].prepare_input(captured[0])
+
+    def forward_weights(self, name: str, weights: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Evaluates the cached batch for several candidate values of one binary weight in a single matmul.
+        :param name: binary weight name
+        :param weights: (n_candidates, *weight_shape) stacked candidate weights
+        :return: (n_candidates, batch_size, n_outputs) model outputs
+        """
+        assert self.is_supported, "Run forward() first"
+        stage_id = self.stage_ids[name]
+        n_candidates = weights.shape[0]
+        inputs = self.inputs[stage_id]
+        batch_size = inputs.shape[0]
+        stage = self.stages[stage_id]
+        outputs = stage.forward_layer(inputs, weights.view(-1, *weights.shape[2:]))
+        outputs = outputs.view(batch_size, n_candidates, -1, *outputs.shape[2:]).transpose(0, 1).contiguous()
+        x = stage.forward_post(outputs.view(n_candidates * batch_size, *outputs.shape[2:]))
+        for stage in self.stages[stage_id + 1:]:
+            x = stage.forward_post(stage.forward_layer(stage.prepare_input(x)))
+        return x.view(n_candidates, batch_size, -1)
+
+    def forward_shifted(self, name: str, shift: float) -> torch.FloatTensor:
+        """
+        Evaluates the cached batch after adding `shift` to the pre-activations of one output unit
+        of a binary layer, for each unit separately.
+        :param name: binary weight name
+        :param shift: pre-activation shift
+        :return: (out_features, batch_size, n_outputs) model outputs
+        """
+        assert self.is_supported, "Run forward() first"
+        stage_id = self.stage_ids[name]
+        assert not self.stages[stage_id].is_conv, "Only linear layers are supported"
+        outputs = self.outputs[stage_id]
+        batch_size, n_units = outputs.shape
+        shifts = shift * torch.eye(n_units).type_as(outputs)
+        x = outputs.unsqueeze(0) + shifts.unsqueeze(1)
+        x = self.stages[stage_id].forward_post(x.view(n_units * batch_size, -1))
+        for stage in self.stages[stage_id + 1:]:
+            x = stage.forward_post(stage.forward_layer(stage.prepare_input(x)))
+        return x.view(n_units, batch_size, -1)
+
+    def forward_delta(self, param_flips: Iterable) -> Variable:
+        """
+        Evaluates the model after the flips have been applied, given the cached activations of the same batch.
+        Call commit() to make the result the new cached state.
+        :param param_flips: applied ParameterFlip list
+        :return: model outputs
+        """
+        assert self.is_supported, "Run forward() first"
+        flips = defaultdict(list)
+        for pflip in param_flips:
+            flips[self.stage_ids[pflip.name]].append(pflip)
+        stage_last_flipped = max(flips.keys())
+        inputs = list(self.inputs)
+        outputs = list(self.outputs)
+        result = self.result
+        changed_units, inputs_delta = None, None
+        for stage_id in range(min(flips.keys()), len(self.stages)):
+            stage = self.stages[stage_id]
+            delta = None
+            if changed_units is not None:
+                delta = stage.forward_units(inputs_delta, changed_units)
+            for pflip in flips[stage_id]:
+                delta_sink = stage.forward_flip(self.inputs[stage_id], pflip)
+                if delta is None:
+                    delta = self.outputs[stage_id].new(self.outputs[stage_id].shape).zero_()
+                delta.index_add_(1, pflip.sink, delta_sink)
+            if delta is None:
+                if stage_id >= stage_last_flipped:
+                    # sign activations stopped changing
+                    break
+                continue
+            outputs[stage_id] = self.outputs[stage_id] + delta
+            x = stage.forward_post(outputs[stage_id])
+            if stage_id == len(self.stages) - 1:
+                result = x
+                break
+            inputs_next = self.stages[stage_id + 1].prepare_input(x)
+            inputs_diff = inputs_next - self.inputs[stage_id + 1]
+            changed = self.stages[stage_id + 1].changed_units(inputs_diff)
+            if changed.numel() == 0:
+                changed_units, inputs_delta = None, None
+            else:
+                changed_units = changed.view(-1)
+                inputs_delta = inputs_diff.index_select(1, changed_units)
+                inputs[stage_id + 1] = inputs_next
+        self.pending = (inputs, outputs, result)
+        return Variable(result, volatile=True)
+
+    def commit(self):
+        """
+        Accepts the last forward_delta() state.
+        """
+        if self.pending is not None:
+            self.inputs, self.outputs, self.result = self.pending
+            self.pending = None
+
+    def discard(self):
+        self.pending = None
+
+    def invalidate(self):
+        """
+        Drops the cached activations after the weights have been changed without forward_delta().
+        """
+        self.inputs, self.outputs, self.result, self.pending = [], [], None, None
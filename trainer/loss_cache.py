@@ -0,0 +1,124 @@
+import zlib
+from collections import OrderedDict
+from typing import Iterable, Tuple, Union
+
+import numpy as np
+import torch.nn as nn
+from torch.autograd import Variable
+
+
+def is_same_data(tensors: Iterable, tensors_other: Iterable) -> bool:
+    """
+    :return: whether the tensors have the memory and shapes of the other tensors
+    """
+    return all(tensor.data_ptr() == other.data_ptr() and tensor.shape == other.shape
+               for tensor, other in zip(tensors, tensors_other))
+
+
+class StateHash(object):
+    """
+    Zobrist hash of the binary weights: the XOR of random 64-bit keys of the positive weights.
+    A sign flip, in either direction, toggles the key of the weight, so the hash is updated from the flipped
+    indices only. The keys of a parameter are seeded by its name, so copies of a model share them.
+    """
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.keys = {}
+
+    def get_keys(self, name: str, param: nn.Parameter) -> np.ndarray:
+        keys = self.keys.get(name, None)
+        if keys is None:
+            random_state = np.random.RandomState(seed=[self.seed, zlib.crc32(name.encode())])
+            keys = random_state.randint(np.iinfo(np.uint64).max, size=param.data.numel(), dtype=np.uint64)
+            self.keys[name] = keys
+        return keys
+
+    def hash_state(self, named_params: Iterable[Tuple[str, nn.Parameter]]) -> int:
+        """
+        :return: hash of the current binary weights
+        """
+        state_hash = 0
+        for name, param in named_params:
+            positive = (param.data.view(-1) > 0).cpu().numpy().astype(bool)
+            state_hash ^= int(np.bitwise_xor.reduce(self.get_keys(name, param)[positive]))
+        return state_hash
+
+    def hash_flips(self, state_hash: int, param_flips: Iterable) -> int:
+        """
+        :param state_hash: hash of the binary weights before (or after) the flips
+        :param param_flips: ParameterFlip list
+        :return: hash of the binary weights after (or before) the flips
+        """
+        for pflip in param_flips:
+            idx_flipped = pflip.get_idx_flipped().cpu().numpy()
+            state_hash ^= int(np.bitwise_xor.reduce(self.get_keys(pflip.name, pflip.param)[idx_flipped]))
+        return state_hash
+
+
+class LossCache(object):
+    """
+    LRU cache of the model outputs and loss for hashed binary weight states on the current data,
+    bounded by the memory of the stored tensors.
+    """
+
+    def __init__(self, max_bytes=2 ** 28):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.entries = OrderedDict()
+        self.entry_bytes = {}
+        self.data = None
+        self.hits = 0
+        self.lookups = 0
+
+    @staticmethod
+    def nbytes(outputs: Variable, loss: Variable) -> int:
+        return sum(var.data.numel() * var.data.element_size() for var in (outputs, loss))
+
+    def clear(self):
+        self.entries.clear()
+        self.entry_bytes.clear()
+        self.n_bytes = 0
+
+    def is_data(self, images: Variable, labels: Variable) -> bool:
+        """
+        :return: whether the cached entries belong to this data
+        """
+        return self.data is not None and is_same_data(self.data, (images.data, labels.data))
+
+    def set_data(self, images: Variable, labels: Variable):
+        """
+        Clears the cache if the data changed. The data is identified by its memory and shape, as in
+        TrainerMCMCFullData, and its tensors are kept so that the memory isn't reused by another batch;
+        modifying the data in-place is not detected.
+        """
+        if not self.is_data(images, labels):
+            self.clear()
+            self.data = (images.data, labels.data)
+
+    def get(self, state_hash: int) -> Union[Tuple[Variable, Variable], None]:
+        self.lookups += 1
+        entry = self.entries.get(state_hash, None)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(state_hash)
+        return entry
+
+    def put(self, state_hash: int, outputs: Variable, loss: Variable):
+        if state_hash in self.entries:
+            self.entries.move_to_end(state_hash)
+            return
+        n_bytes = self.nbytes(outputs, loss)
+        if n_bytes > self.max_bytes:
+            return
+        self.entries[state_hash] = (outputs, loss)
+        self.entry_bytes[state_hash] = n_bytes
+        self.n_bytes += n_bytes
+        while self.n_bytes > self.max_bytes:
+            state_hash_old, _ = self.entries.popitem(last=False)
+            self.n_bytes -= self.entry_bytes.pop(state_hash_old)
+
+    def get_hit_rate(self) -> float:
+        if self.lookups == 0:
+            return 0
+        return self.hits / self.lookups
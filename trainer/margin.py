@@ -0,0 +1,121 @@
+import numpy as np
+import torch
+
+
+def label_margin(outputs: torch.FloatTensor, labels: torch.LongTensor) -> torch.FloatTensor:
+    """
+    :param outputs: (N, n_classes) logits
+    :param labels: (N,) true labels
+    :return: (N,) logit of the true class minus the largest logit of the other classes
+    """
+    labels = labels.view(-1, 1)
+    outputs_other = outputs.clone().scatter_(1, labels, -float('inf'))
+    return outputs.gather(1, labels).squeeze(1) - outputs_other.max(dim=1)[0]
+
+
+def margin_energy(margins: torch.FloatTensor, energy: str) -> torch.FloatTensor:
+    """
+    :param margins: label margins
+    :param energy: 'zero_one' (misclassification) or 'hinge' (multi-class hinge loss)
+    :return: energy of each sample
+    """
+    if energy == 'zero_one':
+        return (margins <= 0).type_as(margins)
+    elif energy == 'hinge':
+        return (1 - margins).clamp(min=0)
+    raise NotImplementedError(f"Unknown energy '{energy}'")
+
+
+class MarginIndex(object):
+    """
+    Train samples, sorted by their label margins. The full sort is done once (a refresh creates a new index);
+    accepted proposals merge the re-evaluated candidates back into the sorted order.
+    Stored outputs and margins of some samples may be outdated, but the margins deviate from the true ones
+    by at most `slack`, and the stored energies are always exact.
+    """
+
+    def __init__(self, outputs: torch.FloatTensor, labels: torch.LongTensor, energy: str):
+        """
+        :param outputs: (N, n_classes) exact logits of the whole train set
+        :param labels: (N,) true labels
+        :param energy: 'zero_one' or 'hinge'
+        """
+        self.outputs = outputs
+        self.labels = labels
+        self.energy = energy
+        self.margins = label_margin(outputs, labels)
+        self.energies = margin_energy(self.margins, energy)
+        self.slack = 0.
+        self.order, self.margins_sorted = None, None
+        self.candidates_range = (0, 0)
+        self.sort()
+
+    def sort(self):
+        margins = self.margins.cpu().numpy()
+        self.order = np.argsort(margins, kind='mergesort')
+        self.margins_sorted = margins[self.order]
+
+    def candidates(self, logit_bound: float):
+        """
+        :param logit_bound: max absolute change of any logit under a proposal
+        :return: indices of the samples whose energy might change, or None
+        """
+        radius = 2 * logit_bound + self.slack
+        if self.energy == 'zero_one':
+            margin_min, margin_max = -radius, radius
+        else:
+            margin_min, margin_max = -float('inf'), 1 + radius
+        start = np.searchsorted(self.margins_sorted, margin_min, side='left')
+        end = np.searchsorted(self.margins_sorted, margin_max, side='right')
+        self.candidates_range = (start, end)
+        if start == end:
+            return None
+        indices = torch.from_numpy(self.order[start: end].astype(np.int64))
+        if self.outputs.is_cuda:
+            indices = indices.cuda()
+        return indices
+
+    def energy_delta(self, indices: torch.LongTensor, outputs: torch.FloatTensor) -> float:
+        """
+        :param indices: candidate samples
+        :param outputs: new logits of the candidates
+        :return: change of the mean energy of the train set
+        """
+        margins = label_margin(outputs, self.labels.index_select(0, indices))
+        energies_new = margin_energy(margins, self.energy)
+        return (energies_new.sum() - self.energies.index_select(0, indices).sum()) / len(self.labels)
+
+    def update(self, indices: torch.LongTensor, outputs: torch.FloatTensor, logit_bound: float):
+        """
+        Accepts a proposal.
+        :param indices: candidate samples, returned by the last `candidates` call, or None
+        :param outputs: new logits of the candidates
+        :param logit_bound: max absolute change of any logit under the proposal
+        """
+        self.slack += 2 * logit_bound
+        if indices is None:
+            return
+        self.outputs.index_copy_(0, indices, outputs)
+        margins = label_margin(outputs, self.labels.index_select(0, indices))
+        self.margins.index_copy_(0, indices, margins)
+        self.energies.index_copy_(0, indices, margin_energy(margins, self.energy))
+        self.merge(indices.cpu().numpy(), margins.cpu().numpy())
+
+    def merge(self, indices: np.ndarray, margins: np.ndarray):
+        """
+        Replaces the candidates, a contiguous range of the sorted order, by their new margins.
+        :param indices: candidate samples
+        :param margins: new margins of the candidates
+        """
+        start, end = self.candidates_range
+        order_new = np.argsort(margins, kind='mergesort')
+        indices, margins = indices[order_new], margins[order_new]
+        order = np.concatenate([self.order[: start], self.order[end:]])
+        margins_sorted = np.concatenate([self.margins_sorted[: start], self.margins_sorted[end:]])
+        positions = np.searchsorted(margins_sorted, margins, side='right')
+        self.order = np.insert(order, positions, indices)
+        self.margins_sorted = np.insert(margins_sorted, positions, margins)
+        self.candidates_range = (0, 0)
+
+    def mean_energy(self) -> float:
+        return self.energies.mean()
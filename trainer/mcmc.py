@@ -1,7 +1,8 @@
 import math
 import random
-from typing import List
+from typing import List, Union, Tuple
 
+import scipy.stats
 import torch
 import torch.nn as nn
 import torch.utils.data
@@ -9,79 +10,167 @@ from torch.autograd import Variable
 
 from layers import compile_inference
 from monitor.monitor import MonitorMCMC
+from trainer.incremental import IncrementalForward
+from trainer.loss_cache import StateHash, LossCache
+from trainer.margin import MarginIndex
+from trainer.proposal import ProposalGenerator
 from trainer.trainer import Trainer
-from utils import named_parameters_binary
+from utils import param_shape_2d, FullDataLoader
+
+
+def as_index(indices, like: torch.FloatTensor) -> torch.LongTensor:
+    """
+    :param indices: list of ints or LongTensor
+    :param like: tensor to be indexed
+    :return: LongTensor on the same device as `like`
+    """
+    if not torch.is_tensor(indices):
+        indices = torch.LongTensor(indices)
+    if like.is_cuda:
+        indices = indices.cuda()
+    return indices
+
+
+def sink_to_source(sink: torch.LongTensor, size_output: int, size_input: int) -> torch.LongTensor:
+    """
+    Maps output neurons of a layer to the input columns of the next layer they feed. An output channel of a conv
+    layer feeds `size_input // size_output` consecutive columns: its kernel positions in the next conv layer or
+    its flattened features in the next linear layer.
+    :param sink: output neuron (channel) indices of the previous layer
+    :param size_output: number of output neurons (channels) of the previous layer
+    :param size_input: number of input columns of the next layer, see param_shape_2d
+    :return: input column indices of the next layer
+    """
+    if size_input % size_output != 0:
+        raise ValueError(f"Cannot chain a layer with {size_output} outputs to a layer with {size_input} inputs")
+    n_columns = size_input // size_output
+    if n_columns == 1:
+        return sink
+    offsets = torch.arange(0, n_columns).long()
+    return (sink.view(-1, 1) * n_columns + offsets.view(1, -1)).view(-1)
+
+
+def per_sample_loss(criterion: nn.Module, outputs: torch.FloatTensor, labels: torch.LongTensor) -> torch.FloatTensor:
+    """
+    :param criterion: loss function; only nn.CrossEntropyLoss is supported
+    :param outputs: (..., batch_size, n_classes) model outputs
+    :param labels: batch labels
+    :return: (..., batch_size) loss of each sample
+    """
+    if not isinstance(criterion, nn.CrossEntropyLoss):
+        raise NotImplementedError(f"Per-sample {criterion.__class__.__name__} is not implemented")
+    outputs_max = outputs.max(dim=-1, keepdim=True)[0]
+    log_sum_exp = (outputs - outputs_max).exp().sum(dim=-1, keepdim=True).log() + outputs_max
+    labels = labels.view(*([1] * (outputs.dim() - 2)), -1, 1).expand(*outputs.shape[:-1], 1)
+    return (log_sum_exp - outputs.gather(-1, labels)).squeeze(-1)
 
 
 class ParameterFlip(object):
     def __init__(self, name: str, param: nn.Parameter, source: List[int], sink: List[int]):
         """
+        Flips the signs of the `sink x source` block of a parameter in-place; restore() flips them back.
+        Conv weights are viewed as (out_channels, in_channels * kernel_height * kernel_width) matrices.
         :param name: (sink) parameter's name
         :param param: nn.Parameter
-        :param source: input layer neuron indices
-        :param sink: output layer neuron indices
+        :param source: input layer neuron indices (input channel and kernel position for conv layers)
+        :param sink: output layer neuron indices (output channels for conv layers)
         """
-        assert param.ndimension() == 2, "For now, only nn.Linear is supported"
         self.name = name
         self.param = param
-        self.source = source
-        self.sink = sink
+        self.source = as_index(source, like=param.data)
+        self.sink = as_index(sink, like=param.data)
+        size_output, size_input = param_shape_2d(param)
+        self.idx_flipped = (self.sink.view(-1, 1) * size_input + self.source.view(1, -1)).view(-1)
+        self.is_flipped = False
 
-    def construct_flip(self) -> torch.ByteTensor:
-        # hack to select and modify a sub-matrix
-        idx_connection_flip = torch.ByteTensor(self.param.data.shape).fill_(0)
-        idx_connection_flip_output = idx_connection_flip[self.sink, :]
-        idx_connection_flip_output[:, self.source] = True
-        idx_connection_flip[self.sink, :] = idx_connection_flip_output
-        return idx_connection_flip
+    def apply(self, tensor: torch.FloatTensor):
+        """
+        Flips the signs of the same connections in a tensor of the parameter's shape.
+        """
+        data = tensor.view(-1)
+        data.index_copy_(0, self.idx_flipped, data.index_select(0, self.idx_flipped).neg_())
 
     def flip(self):
-        idx_flipped = self.get_idx_flipped()
-        idx_flipped_cuda = idx_flipped
-        if self.param.is_cuda:
-            idx_flipped_cuda = idx_flipped.cuda()
-        self.param[idx_flipped_cuda] *= -1
-        del idx_flipped_cuda
+        self.apply(self.param.data)
+        self.is_flipped = not self.is_flipped
+
+    def get_idx_flipped(self) -> torch.LongTensor:
+        """
+        :return: flat indices of the flipped connections
+        """
+        return self.idx_flipped
 
-    def get_idx_flipped(self) -> torch.ByteTensor:
-        return self.construct_flip()
+    def weight_delta(self) -> torch.FloatTensor:
+        """
+        :return: (W_flipped - W_original)[sink, source] block
+        """
+        block = self.param.data.view(self.param.data.shape[0], -1)
+        block = block.index_select(0, self.sink).index_select(1, self.source)
+        if not self.is_flipped:
+            block.neg_()
+        return 2 * block
 
     def restore(self):
-        self.flip()
+        if self.is_flipped:
+            self.flip()
 
 
-class ParameterFlipCached(ParameterFlip):
-    def __init__(self, name: str, param: nn.Parameter, source: List[int], sink: List[int]):
+class ParameterFlipSparse(ParameterFlip):
+    def __init__(self, name: str, param: nn.Parameter, idx_flipped: torch.LongTensor):
         """
+        Flips an arbitrary set of connections of a parameter (not necessarily a `sink x source` block).
         :param name: (sink) parameter's name
         :param param: nn.Parameter
-        :param source: input layer neuron indices
-        :param sink: output layer neuron indices
+        :param idx_flipped: non-empty flat indices of the connections to flip
         """
-        super().__init__(name, param, source, sink)
-        self.data_backup = self.param.data.clone()
-        self.idx_flipped = self.construct_flip()
-
-    def get_idx_flipped(self):
-        return self.idx_flipped
-
-    def restore(self):
-        self.param.data = self.data_backup
+        self.name = name
+        self.param = param
+        self.idx_flipped = as_index(idx_flipped, like=param.data)
+        mask = param.data.new(*param_shape_2d(param)).zero_()
+        mask.view(-1).index_fill_(0, self.idx_flipped, 1)
+        self.sink = mask.sum(dim=1).nonzero().view(-1)
+        self.source = mask.sum(dim=0).nonzero().view(-1)
+        self.mask_block = mask.index_select(0, self.sink).index_select(1, self.source)
+        self.is_flipped = False
+
+    def weight_delta(self) -> torch.FloatTensor:
+        """
+        :return: (W_flipped - W_original)[sink, source] block; connections that are not flipped are zeros
+        """
+        return super().weight_delta() * self.mask_block
 
 
 class TrainerMCMC(Trainer):
-    def __init__(self, model: nn.Module, criterion: nn.Module, dataset_name: str, flip_ratio=0.1, **kwargs):
-        compile_inference(model)
+    def __init__(self, model: nn.Module, criterion: nn.Module, dataset_name: str, flip_ratio=0.1, incremental=True,
+                 proposal_kwargs=dict(), loss_cache_bytes=0, **kwargs):
+        """
+        :param flip_ratio: fraction of sink and source neurons to flip at each MCMC step
+        :param incremental: evaluate proposals by updating cached activations (IncrementalForward)
+                            instead of a full forward pass; unsupported models fall back to the full pass
+        :param proposal_kwargs: ProposalGenerator arguments
+        :param loss_cache_bytes: memory budget of the memoized outputs and losses of weight states on the current data
+                                 (used by train_batch_mcmc); 0 disables the cache
+        """
+        compile_inference(model, keep_batch_norm=True)
         super().__init__(model, criterion, dataset_name, monitor_cls=MonitorMCMC, **kwargs)
         self.volatile = True
         self.flip_ratio = flip_ratio
-        self.monitor.log(f"Flip ratio: {flip_ratio}")
+        self.incremental = incremental
+        self.evaluators = {}
+        self.proposal = ProposalGenerator(**proposal_kwargs)
+        self.state_hash = StateHash()
+        self.loss_cache = LossCache(max_bytes=loss_cache_bytes) if loss_cache_bytes > 0 else None
+        self.hash_current = None  # hash of the current binary weights, if known
         self.accepted_count = 0
         self.update_calls = 0
+        self.flips_accepted = None
         for param in model.parameters():
             param.requires_grad = False
             param.volatile = True
-        self._monitor_functions()
+        if self.parent is None:
+            self.monitor.log(f"Flip ratio: {flip_ratio}")
+            self.monitor.log(f"Proposals: {self.proposal}")
+            self._monitor_functions()
 
     def get_acceptance_ratio(self) -> float:
         if self.update_calls == 0:
@@ -89,8 +178,28 @@ class TrainerMCMC(Trainer):
         else:
             return self.accepted_count / self.update_calls
 
-    def sample_neurons(self, size) -> List[int]:
-        return random.sample(range(size), k=math.ceil(size * self.flip_ratio))
+    def mcmc_step(self, param_flips: List[ParameterFlip]):
+        """
+        Reports the proposed flips of a finished MCMC step; the accepted ones are left flipped.
+        """
+        self.flips_accepted = [pflip for pflip in param_flips if pflip.is_flipped]
+        if self.hash_current is not None:
+            self.hash_current = self.state_hash.hash_flips(self.hash_current, self.flips_accepted)
+        self.monitor.mcmc_step(param_flips)
+
+    def get_evaluator(self) -> Union[IncrementalForward, None]:
+        if not self.incremental:
+            return None
+        evaluator = self.evaluators.get(self.model, None)
+        if evaluator is None:
+            # keyed by the model object, in case the model of the trainer is replaced; ParallelTempering swaps
+            # the temperatures of its chains, not their models, so each chain trainer keeps a single evaluator
+            evaluator = IncrementalForward(self.model)
+            self.evaluators[self.model] = evaluator
+        return evaluator
+
+    def sample_neurons(self, size) -> torch.LongTensor:
+        return self.proposal.sample_neurons(size, flip_ratio=self.flip_ratio)
 
     def accept(self, loss_new: Variable, loss_old: Variable) -> float:
         loss_delta = (loss_new - loss_old).data[0]
@@ -100,53 +209,121 @@ class TrainerMCMC(Trainer):
             proba_accept = math.exp(-loss_delta / (self.flip_ratio * 1))
         return proba_accept
 
-    def train_batch_mcmc(self, images: Variable, labels: Variable, named_params):
-        outputs_orig = self.model(images)
-        loss_orig = self.criterion(outputs_orig, labels)
+    def evaluate_orig(self, images: Variable, labels: Variable):
+        """
+        :return: outputs and loss of the current (not flipped) model
+        """
+        evaluator = self.get_evaluator()
+        if evaluator is None:
+            outputs = self.model(images)
+        else:
+            outputs = evaluator.forward(images)
+        return outputs, self.criterion(outputs, labels)
+
+    @staticmethod
+    def accept_vector(loss_delta: torch.FloatTensor, flip_ratio: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Vectorized accept() for several chains.
+        :param loss_delta: loss_new - loss_old of each chain
+        :param flip_ratio: flip ratio of each chain
+        :return: acceptance probabilities
+        """
+        return torch.exp(-loss_delta / flip_ratio).clamp_(max=1)
 
+    def sample_flips(self, named_params) -> List[ParameterFlip]:
+        """
+        :param named_params: chain of binary parameters; the sink of a flip feeds the source of the next one
+        :return: random block flips, not applied yet
+        """
         param_flips = []
-        source = None
+        sink, size_sink = None, None
         for name, param in named_params:
-            size_output, size_input = param.data.shape
-            if source is None:
+            size_output, size_input = param_shape_2d(param)
+            if sink is None:
                 source = self.sample_neurons(size_input)
+            else:
+                source = sink_to_source(sink, size_output=size_sink, size_input=size_input)
             sink = self.sample_neurons(size_output)
-            pflip = ParameterFlipCached(name, param, source, sink)
-            param_flips.append(pflip)
-            source = sink
+            size_sink = size_output
+            param_flips.append(ParameterFlip(name, param, source, sink))
+        return param_flips
+
+    def train_batch_mcmc(self, images: Variable, labels: Variable, param_flips: List[ParameterFlip]):
+        evaluator = self.get_evaluator()
+        cached_orig, cached_flipped = None, None
+        if self.loss_cache is not None:
+            self.loss_cache.set_data(images, labels)
+            if self.hash_current is None:
+                self.hash_current = self.state_hash.hash_state(self.proposal.named_parameters(self.model))
+            hash_orig = self.hash_current
+            hash_flipped = self.state_hash.hash_flips(hash_orig, param_flips)
+            cached_flipped = self.loss_cache.get(hash_flipped)
+            if cached_flipped is not None:
+                cached_orig = self.loss_cache.get(hash_orig)
+
+        if cached_orig is not None and cached_flipped is not None:
+            outputs_orig, loss_orig = cached_orig
+        else:
+            outputs_orig, loss_orig = self.evaluate_orig(images, labels)
+            if self.loss_cache is not None:
+                self.loss_cache.put(hash_orig, outputs_orig, loss_orig)
 
         for pflip in param_flips:
             pflip.flip()
 
-        outputs = self.model(images)
-        loss = self.criterion(outputs, labels)
+        if cached_flipped is not None:
+            outputs, loss = cached_flipped
+        else:
+            if evaluator is not None and evaluator.is_supported:
+                outputs = evaluator.forward_delta(param_flips)
+            else:
+                outputs = self.model(images)
+            loss = self.criterion(outputs, labels)
+            if self.loss_cache is not None:
+                self.loss_cache.put(hash_flipped, outputs, loss)
         proba_accept = self.accept(loss_new=loss, loss_old=loss_orig)
         proba_draw = random.random()
         if proba_draw <= proba_accept:
             self.accepted_count += 1
+            if evaluator is not None and cached_flipped is not None:
+                # the cached activations don't match the new weights
+                evaluator.invalidate()
+            elif evaluator is not None:
+                evaluator.commit()
         else:
             # reject
             for pflip in param_flips:
                 pflip.restore()
+            if evaluator is not None:
+                evaluator.discard()
             outputs = outputs_orig
             loss = loss_orig
-        self.monitor.mcmc_step(param_flips)
+        self.mcmc_step(param_flips)
 
         del param_flips
 
         self.update_calls += 1
         return outputs, loss
 
+    def propose_flips(self) -> List[ParameterFlip]:
+        """
+        :return: block flip of one binary parameter, not applied yet
+        """
+        if self.proposal.systematic:
+            name, param, source, sink = self.proposal.next_block(self.model, flip_ratio=self.flip_ratio)
+            return [ParameterFlip(name, param, source, sink)]
+        return self.sample_flips([self.proposal.choose_parameter(self.model)])
+
     def train_batch(self, images, labels):
-        return self.train_batch_mcmc(images, labels, named_params=[
-            random.choice(named_parameters_binary(self.model))
-        ])
+        return self.train_batch_mcmc(images, labels, self.propose_flips())
 
     def reset_checkpoint(self):
         super().reset_checkpoint()
         self.flip_ratio = max(self.flip_ratio * 0.7, 1e-3)
         self.accepted_count = 0
         self.update_calls = 0
+        # the weights are reloaded from the checkpoint
+        self.hash_current = None
 
     def _epoch_finished(self, epoch, outputs, labels):
         super()._epoch_finished(epoch, outputs, labels)
@@ -164,12 +341,19 @@ class TrainerMCMC(Trainer):
             ylabel='Sign flip ratio, %',
             title='MCMC flip_ratio'
         ))
+        if self.loss_cache is not None:
+            self.monitor.register_func(self.loss_cache.get_hit_rate, opts=dict(
+                xlabel='Epoch',
+                ylabel='Hit rate',
+                title='MCMC loss cache hits / lookups'
+            ))
 
 
 class TrainerMCMCTree(TrainerMCMC):
 
     def train_batch(self, images, labels):
-        return self.train_batch_mcmc(images, labels, named_params=named_parameters_binary(self.model))
+        param_flips = self.sample_flips(self.proposal.named_parameters(self.model))
+        return self.train_batch_mcmc(images, labels, param_flips)
 
 
 class TrainerMCMCGibbs(TrainerMCMC):
@@ -184,3 +368,508 @@ class TrainerMCMCGibbs(TrainerMCMC):
         except OverflowError:
             proba_accept = int(loss_delta > 0)
         return proba_accept
+
+    @staticmethod
+    def accept_vector(loss_delta: torch.FloatTensor, flip_ratio: torch.FloatTensor) -> torch.FloatTensor:
+        return torch.sigmoid(-loss_delta / flip_ratio)
+
+
+class TrainerMCMCHeatBath(TrainerMCMCGibbs):
+    """
+    Random-scan heat-bath sweeps over single connections of one layer per batch.
+    The exact loss change of flipping every single connection of a linear layer is computed at once:
+    flipping w_ji shifts the pre-activation of unit j by -2 * w_ji * x_i = +-2, so only 2 * out_features
+    shifted evaluations of the downstream layers and one matmul are needed. Connections of the sweep
+    are visited in random order and flipped with probability sigmoid(-delta / T);
+    the delta matrix is recomputed after each accepted flip only.
+    """
+
+    def __init__(self, model: nn.Module, criterion: nn.Module, dataset_name: str, sweep_size=100, **kwargs):
+        """
+        :param sweep_size: number of connections visited per batch
+        """
+        super().__init__(model, criterion, dataset_name, **kwargs)
+        self.sweep_size = sweep_size
+        if self.parent is None:
+            self.monitor.log(f"Heat-bath sweep size: {sweep_size}")
+
+    def loss_delta_matrix(self, evaluator: IncrementalForward, name: str,
+                          labels: torch.LongTensor) -> torch.FloatTensor:
+        """
+        :return: (out_features, in_features) loss change of flipping each single connection of the layer
+        """
+        stage_id = evaluator.stage_ids[name]
+        inputs = evaluator.inputs[stage_id]
+        loss_orig = per_sample_loss(self.criterion, evaluator.result, labels)
+        delta_plus = per_sample_loss(self.criterion, evaluator.forward_shifted(name, shift=2), labels) - loss_orig
+        delta_minus = per_sample_loss(self.criterion, evaluator.forward_shifted(name, shift=-2), labels) - loss_orig
+        # the shift is +2 where w_ji * x_i = -1 and -2 where w_ji * x_i = +1
+        delta_sum = (delta_plus + delta_minus).sum(dim=1, keepdim=True)
+        delta_diff = torch.mm(delta_plus - delta_minus, inputs)
+        return (delta_sum - evaluator.stages[stage_id].weight * delta_diff) / (2 * inputs.shape[0])
+
+    def train_batch(self, images, labels):
+        evaluator = self.get_evaluator()
+        is_evaluated = False
+        if evaluator is not None and evaluator.is_supported is None:
+            # the support of the model is known after the first forward pass
+            self.evaluate_orig(images, labels)
+            is_evaluated = True
+        name, param = self.proposal.choose_parameter(self.model)
+        if evaluator is None or not evaluator.is_supported or evaluator.stages[evaluator.stage_ids[name]].is_conv:
+            # a block flip of the same parameter
+            return self.train_batch_mcmc(images, labels, self.sample_flips([(name, param)]))
+        if not is_evaluated:
+            self.evaluate_orig(images, labels)
+        n_connections = param.data.numel()
+        idx_sweep = as_index(self.proposal.sample(n_connections, k=min(self.sweep_size, n_connections)),
+                             like=param.data)
+        proba_draw = torch.rand(len(idx_sweep))
+        param_flips = []
+        visited = 0
+        while visited < len(idx_sweep):
+            loss_delta = self.loss_delta_matrix(evaluator, name, labels.data).view(-1)
+            loss_delta = loss_delta.index_select(0, idx_sweep[visited:])
+            proba_accept = self.accept_vector(loss_delta, self.flip_ratio).cpu()
+            accepted = (proba_draw[visited:] < proba_accept).nonzero()
+            if accepted.numel() == 0:
+                # the rest of the sweep is rejected
+                self.update_calls += len(idx_sweep) - visited
+                break
+            offset = int(accepted[0][0])
+            pflip = ParameterFlipSparse(name, param, idx_sweep[visited + offset: visited + offset + 1])
+            pflip.flip()
+            evaluator.forward_delta([pflip])
+            evaluator.commit()
+            param_flips.append(pflip)
+            self.accepted_count += 1
+            self.update_calls += offset + 1
+            visited += offset + 1
+        self.mcmc_step(param_flips)
+        outputs = Variable(evaluator.result, volatile=True)
+        return outputs, self.criterion(outputs, labels)
+
+
+class TrainerMCMCAusterity(TrainerMCMC):
+    """
+    Approximate Metropolis-Hastings with a sequential test ("austerity" MH).
+    A proposal is accepted if mean(loss_new - loss_old) < -T * log(u), u ~ U(0, 1).
+    The per-sample loss differences are evaluated on growing chunks of the batch, and the decision is made
+    as soon as a t-test rejects the hypothesis that the mean equals the threshold with the error `error_tol`.
+    Only the evaluated samples are returned as the batch outputs.
+    """
+
+    def __init__(self, model: nn.Module, criterion: nn.Module, dataset_name: str, chunk_size=32, error_tol=0.05,
+                 **kwargs):
+        """
+        :param chunk_size: number of samples evaluated at each stage of the test
+        :param error_tol: t-test significance level
+        """
+        super().__init__(model, criterion, dataset_name, **kwargs)
+        self.chunk_size = chunk_size
+        self.error_tol = error_tol
+        self.samples_used = 0
+        self.samples_total = 0
+        if self.parent is None:
+            self.monitor.log(f"Austerity MH: chunk size {chunk_size}, error tolerance {error_tol}")
+            self.monitor.register_func(self.get_samples_used_ratio, opts=dict(
+                xlabel='Epoch',
+                ylabel='Samples used, %',
+                title='MCMC samples used per decision'
+            ))
+
+    def get_samples_used_ratio(self) -> float:
+        if self.samples_total == 0:
+            return 0
+        return 100. * self.samples_used / self.samples_total
+
+    def evaluate_chunk(self, images: Variable,
+                       param_flips: List[ParameterFlip]) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        """
+        :return: outputs of the current and of the flipped model; the flips are not applied on return
+        """
+        evaluator = self.get_evaluator()
+        if evaluator is None:
+            outputs_orig = self.model(images)
+        else:
+            outputs_orig = evaluator.forward(images)
+        for pflip in param_flips:
+            pflip.flip()
+        if evaluator is not None and evaluator.is_supported:
+            outputs = evaluator.forward_delta(param_flips)
+            evaluator.discard()
+        else:
+            outputs = self.model(images)
+        for pflip in param_flips:
+            pflip.restore()
+        return outputs_orig.data, outputs.data
+
+    def train_batch(self, images, labels):
+        param_flips = self.propose_flips()
+        batch_size = len(labels)
+        threshold = -self.flip_ratio * math.log(1. - random.random())
+        outputs_orig, outputs_new, loss_diff = [], [], []
+        n_used = 0
+        while True:
+            chunk = slice(n_used, n_used + self.chunk_size)
+            chunk_orig, chunk_new = self.evaluate_chunk(images[chunk], param_flips)
+            labels_chunk = labels.data[chunk]
+            loss_diff.append(per_sample_loss(self.criterion, chunk_new, labels_chunk) -
+                             per_sample_loss(self.criterion, chunk_orig, labels_chunk))
+            outputs_orig.append(chunk_orig)
+            outputs_new.append(chunk_new)
+            n_used = min(n_used + self.chunk_size, batch_size)
+            diff = torch.cat(loss_diff)
+            diff_mean = diff.mean()
+            if n_used == batch_size:
+                break
+            diff_std = diff.std()
+            if diff_std == 0:
+                break
+            # finite population correction
+            std_err = diff_std / math.sqrt(n_used) * math.sqrt(1 - (n_used - 1) / (batch_size - 1))
+            tstat = abs(diff_mean - threshold) / std_err
+            if scipy.stats.t.sf(tstat, df=n_used - 1) < self.error_tol:
+                break
+        self.samples_used += n_used
+        self.samples_total += batch_size
+        if diff_mean < threshold:
+            self.accepted_count += 1
+            for pflip in param_flips:
+                pflip.flip()
+            outputs = outputs_new
+        else:
+            outputs = outputs_orig
+        self.mcmc_step(param_flips)
+        self.update_calls += 1
+        outputs = Variable(torch.cat(outputs), volatile=True)
+        return outputs, self.criterion(outputs, Variable(labels.data[: n_used], volatile=True))
+
+    def reset_checkpoint(self):
+        super().reset_checkpoint()
+        self.samples_used = 0
+        self.samples_total = 0
+
+
+class TrainerMCMCGradient(TrainerMCMC):
+    """
+    Gradient-informed proposals. The loss change of flipping a binary weight w is estimated to the first order
+    with the straight-through gradient as -2 * w * grad. Each connection of a random layer is flipped
+    independently with probability sigmoid(logit(q) - delta / 2T), where q is the fraction of connections that
+    TrainerMCMC flips at once, and the proposal is accepted with the Metropolis-Hastings correction
+    min(1, exp(-(loss_new - loss_old) / T) * q(old | new) / q(new | old)).
+    """
+
+    def loss_gradient(self, images: Variable, labels: Variable,
+                      param: nn.Parameter) -> Tuple[Variable, Variable, torch.FloatTensor]:
+        """
+        :return: outputs, loss and the gradient of the loss w.r.t. the binary parameter
+        """
+        # TrainerMCMC marks the parameters volatile, which would propagate and make the graph non-differentiable
+        param.volatile = False
+        param.requires_grad = True
+        try:
+            outputs = self.model(Variable(images.data))
+            loss = self.criterion(outputs, Variable(labels.data))
+            grad, = torch.autograd.grad(loss, param)
+        finally:
+            param.requires_grad = False
+            param.volatile = True
+        return Variable(outputs.data, volatile=True), Variable(loss.data, volatile=True), grad.data
+
+    def proposal_logits(self, param: nn.Parameter, grad: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        :return: logits of the probabilities to flip each connection of the parameter
+        """
+        size_output, size_input = param_shape_2d(param)
+        n_flips = math.ceil(size_output * self.flip_ratio) * math.ceil(size_input * self.flip_ratio)
+        proba_base = min(n_flips / param.data.numel(), 0.5)
+        loss_delta_approx = -2 * param.data * grad
+        return math.log(proba_base / (1 - proba_base)) - loss_delta_approx / (2 * self.flip_ratio)
+
+    @staticmethod
+    def log_proba_proposal(logits: torch.FloatTensor, mask: torch.FloatTensor) -> float:
+        """
+        :param logits: logits of the flip probabilities
+        :param mask: 1 for flipped connections, 0 otherwise
+        :return: log probability to flip exactly the masked connections
+        """
+        log_proba_keep = -(logits.clamp(min=0) + torch.log1p(torch.exp(-logits.abs())))
+        return log_proba_keep.sum() + (logits * mask).sum()
+
+    def train_batch(self, images, labels):
+        name, param = self.proposal.choose_parameter(self.model)
+        outputs_orig, loss_orig, grad = self.loss_gradient(images, labels, param)
+        logits = self.proposal_logits(param, grad)
+        mask = (logits.new(logits.shape).uniform_() < torch.sigmoid(logits)).type_as(logits)
+        idx_flipped = mask.view(-1).nonzero()
+        if idx_flipped.numel() == 0:
+            # the proposal is the current state and is trivially accepted
+            self.accepted_count += 1
+            self.mcmc_step([])
+            self.update_calls += 1
+            return outputs_orig, loss_orig
+        pflip = ParameterFlipSparse(name, param, idx_flipped.view(-1))
+        pflip.flip()
+        outputs, loss, grad_flipped = self.loss_gradient(images, labels, param)
+        logits_reverse = self.proposal_logits(param, grad_flipped)
+        log_proba_ratio = self.log_proba_proposal(logits_reverse, mask) - self.log_proba_proposal(logits, mask)
+        loss_delta = (loss - loss_orig).data[0]
+        proba_accept = math.exp(min(-loss_delta / self.flip_ratio + log_proba_ratio, 0.))
+        if random.random() <= proba_accept:
+            self.accepted_count += 1
+        else:
+            pflip.restore()
+            outputs = outputs_orig
+            loss = loss_orig
+        self.mcmc_step([pflip])
+        self.update_calls += 1
+        return outputs, loss
+
+
+class TrainerMCMCMultipleTry(TrainerMCMC):
+    """
+    Multiple-try Metropolis: draws `n_tries` candidate flips of one layer and evaluates them in a single
+    batched forward pass. A candidate is selected with probability ~ exp(-loss/kT) and accepted with
+    probability min(1, sum(w(candidates)) / sum(w(references))), where the references are `n_tries - 1`
+    flips drawn from the selected candidate plus the current state.
+    """
+
+    def __init__(self, model: nn.Module, criterion: nn.Module, dataset_name: str, n_tries=8, **kwargs):
+        super().__init__(model, criterion, dataset_name, **kwargs)
+        self.n_tries = n_tries
+        if self.parent is None:
+            self.monitor.log(f"Multiple-try Metropolis: {n_tries} tries")
+
+    def sample_flip(self, name: str, param: nn.Parameter) -> ParameterFlip:
+        size_output, size_input = param_shape_2d(param)
+        return ParameterFlip(name, param, source=self.sample_neurons(size_input),
+                             sink=self.sample_neurons(size_output))
+
+    def log_weight(self, loss: float) -> float:
+        return -loss / self.flip_ratio
+
+    def evaluate_flips(self, images: Variable, labels: Variable, param_flips: List[ParameterFlip]):
+        """
+        :return: outputs and losses of the model with each of the flips applied (one at a time)
+        """
+        evaluator = self.get_evaluator()
+        if evaluator is not None and evaluator.is_supported:
+            pflip = param_flips[0]
+            weights = pflip.param.data.unsqueeze(0).repeat(len(param_flips), *([1] * pflip.param.data.dim()))
+            for weight, pflip in zip(weights, param_flips):
+                pflip.apply(weight)
+            outputs = evaluator.forward_weights(pflip.name, weights)
+            outputs = [Variable(outputs_candidate, volatile=True) for outputs_candidate in outputs]
+        else:
+            outputs = []
+            for pflip in param_flips:
+                pflip.flip()
+                outputs.append(self.model(images))
+                pflip.restore()
+        losses = [self.criterion(outputs_candidate, labels) for outputs_candidate in outputs]
+        return outputs, losses
+
+    @staticmethod
+    def log_sum_exp(values: List[float]) -> float:
+        value_max = max(values)
+        return value_max + math.log(sum(math.exp(value - value_max) for value in values))
+
+    def train_batch(self, images, labels):
+        name, param = self.proposal.choose_parameter(self.model)
+        outputs_orig, loss_orig = self.evaluate_orig(images, labels)
+
+        candidates = [self.sample_flip(name, param) for _ in range(self.n_tries)]
+        outputs_candidates, losses_candidates = self.evaluate_flips(images, labels, candidates)
+        log_weights = [self.log_weight(loss.data[0]) for loss in losses_candidates]
+        log_norm = self.log_sum_exp(log_weights)
+        proba_select = [math.exp(log_weight - log_norm) for log_weight in log_weights]
+        chosen_id = random.choices(range(self.n_tries), weights=proba_select)[0]
+        pflip = candidates[chosen_id]
+        pflip.flip()
+
+        references = [self.sample_flip(name, param) for _ in range(self.n_tries - 1)]
+        _, losses_references = self.evaluate_flips(images, labels, references)
+        log_weights_references = [self.log_weight(loss.data[0]) for loss in losses_references]
+        log_weights_references.append(self.log_weight(loss_orig.data[0]))
+        log_ratio = log_norm - self.log_sum_exp(log_weights_references)
+        proba_accept = math.exp(min(log_ratio, 0.))
+        if random.random() <= proba_accept:
+            self.accepted_count += 1
+            outputs = outputs_candidates[chosen_id]
+            loss = losses_candidates[chosen_id]
+        else:
+            pflip.restore()
+            outputs = outputs_orig
+            loss = loss_orig
+        self.mcmc_step([pflip])
+        self.update_calls += 1
+        return outputs, loss
+
+
+class TrainerMCMCFullData(TrainerMCMC):
+    """
+    Exact Metropolis sampling with the loss of the whole train set as the energy.
+    The outputs of every train sample are kept in memory; each proposal is evaluated as a delta to them
+    (see IncrementalForward), committed on accept and dropped on reject.
+    As a sub-chain (`parent` is set), it is fed the parent's batches; the cached state is then reused
+    only while the batch stays the same.
+    """
+
+    def __init__(self, model: nn.Module, criterion: nn.Module, dataset_name: str, **kwargs):
+        super().__init__(model, criterion, dataset_name, **kwargs)
+        if self.parent is None:
+            self.train_loader = FullDataLoader(self.train_loader)
+        self.state_orig = None  # outputs, loss and labels of the batch for the current weights
+        self.state_model = None
+        self.state_batch = None  # images and labels of the cached state; kept alive, so their storage is not reused
+
+    def set_state_batch(self, images: Variable, labels: Variable):
+        self.state_model = self.model
+        self.state_batch = (images.data, labels.data)
+
+    def is_state_batch(self, images: Variable, labels: Variable) -> bool:
+        """
+        :return: whether the cached state belongs to this batch and the current model
+        """
+        if self.state_batch is None or self.state_model is not self.model:
+            return False
+        images_state, labels_state = self.state_batch
+        return images_state.data_ptr() == images.data.data_ptr() and images_state.shape == images.data.shape \
+            and labels_state.data_ptr() == labels.data.data_ptr() and labels_state.shape == labels.data.shape
+
+    def evaluate_orig(self, images: Variable, labels: Variable):
+        evaluator = self.get_evaluator()
+        is_invalidated = evaluator is not None and evaluator.is_supported and evaluator.result is None
+        if self.state_orig is None or not self.is_state_batch(images, labels) or is_invalidated:
+            outputs, loss = super().evaluate_orig(images, labels)
+            self.state_orig = (outputs, loss, labels)
+            self.set_state_batch(images, labels)
+        outputs, loss, labels = self.state_orig
+        return outputs, loss
+
+    def train_batch(self, images, labels):
+        outputs, loss = super().train_batch(images, labels)
+        self.state_orig = (outputs, loss, labels)
+        return outputs, loss
+
+    def get_outputs_full(self, eval_loader: torch.utils.data.DataLoader):
+        if self.state_orig is None or self.state_model is not self.model or \
+                not isinstance(self.train_loader, FullDataLoader):
+            return super().get_outputs_full(eval_loader)
+        outputs, loss, labels = self.state_orig
+        return outputs, labels
+
+    def reset_checkpoint(self):
+        super().reset_checkpoint()
+        self.state_orig = None
+        self.state_batch = None
+
+
+class TrainerMCMCMargin(TrainerMCMCFullData):
+    """
+    Full train set Metropolis sampling with a 0-1 or hinge energy of the label margins (see MarginIndex).
+    Binary inputs are +-1, so a flip changes any logit by at most 2 * (|source| + number of changed inputs
+    of the last layer); only the samples with margins within twice that bound are re-evaluated,
+    the others keep their cached energies.
+    The last binary layer must output the logits directly (no modules after it).
+    """
+
+    def __init__(self, model: nn.Module, criterion: nn.Module, dataset_name: str, energy='zero_one',
+                 refresh_ratio=0.5, **kwargs):
+        """
+        :param energy: 'zero_one' or 'hinge'
+        :param refresh_ratio: re-evaluate the whole train set, resetting the accumulated margin slack,
+                              if more than this fraction of samples are candidates
+        """
+        super().__init__(model, criterion, dataset_name, **kwargs)
+        self.energy = energy
+        self.refresh_ratio = refresh_ratio
+        self.margin_index = None
+        self.is_prunable = False
+        self.samples_touched = 0
+        self.samples_total = 0
+        if self.parent is None:
+            self.monitor.log(f"Margin pruning: {energy} energy")
+            self.monitor.register_func(self.get_samples_touched_ratio, opts=dict(
+                xlabel='Epoch',
+                ylabel='Samples re-evaluated, %',
+                title='MCMC samples re-evaluated per step'
+            ))
+
+    def get_samples_touched_ratio(self) -> float:
+        if self.samples_total == 0:
+            return 0
+        return 100. * self.samples_touched / self.samples_total
+
+    def refresh(self, images: Variable, labels: Variable):
+        """
+        Evaluates the whole train set.
+        """
+        evaluator = self.get_evaluator()
+        if evaluator is None:
+            outputs = self.model(images)
+        else:
+            outputs = evaluator.forward(images)
+        self.is_prunable = evaluator is not None and evaluator.is_supported and \
+                           not evaluator.stages[-1].is_conv and len(evaluator.stages[-1].post_modules) == 0
+        self.margin_index = MarginIndex(outputs.data, labels.data, energy=self.energy)
+        self.set_state_batch(images, labels)
+
+    def logit_bound(self, param_flips: List[ParameterFlip]) -> float:
+        """
+        :return: max absolute change of any logit after the flips
+        """
+        evaluator = self.get_evaluator()
+        stage_last = len(evaluator.stages) - 1
+        size_input_last = param_shape_2d(evaluator.stages[stage_last].decorator.layer.weight)[1]
+        bound, changed_inputs = 0, 0
+        for pflip in param_flips:
+            stage_id = evaluator.stage_ids[pflip.name]
+            if stage_id == stage_last:
+                bound += 2 * len(pflip.source)
+            elif stage_id == stage_last - 1 and not evaluator.stages[stage_id].is_conv:
+                # only the sink units of the previous layer may change their signs
+                changed_inputs += len(pflip.sink)
+            else:
+                changed_inputs = size_input_last
+        return bound + 2 * min(changed_inputs, size_input_last)
+
+    def train_batch(self, images, labels):
+        if self.margin_index is None or not self.is_state_batch(images, labels):
+            self.refresh(images, labels)
+        if not self.is_prunable:
+            return super().train_batch(images, labels)
+        param_flips = self.propose_flips()
+        logit_bound = self.logit_bound(param_flips)
+        candidates = self.margin_index.candidates(logit_bound)
+        if candidates is not None and self.margin_index.slack > 0 and \
+                len(candidates) > self.refresh_ratio * len(labels):
+            self.refresh(images, labels)
+            candidates = self.margin_index.candidates(logit_bound)
+        for pflip in param_flips:
+            pflip.flip()
+        energy_delta, outputs_candidates = 0., None
+        if candidates is not None:
+            images_candidates = Variable(images.data.index_select(0, candidates), volatile=True)
+            outputs_candidates = self.model(images_candidates).data
+            energy_delta = self.margin_index.energy_delta(candidates, outputs_candidates)
+            self.samples_touched += len(candidates)
+        self.samples_total += len(labels)
+        proba_accept = self.accept_vector(torch.FloatTensor([energy_delta]), torch.FloatTensor([self.flip_ratio]))[0]
+        if random.random() <= proba_accept:
+            self.accepted_count += 1
+            self.margin_index.update(candidates, outputs_candidates, logit_bound)
+        else:
+            for pflip in param_flips:
+                pflip.restore()
+        self.mcmc_step(param_flips)
+        self.update_calls += 1
+        # outputs of the samples, which were not re-evaluated, may be outdated, but their energies are exact
+        outputs = Variable(self.margin_index.outputs, volatile=True)
+        loss = Variable(torch.FloatTensor([self.margin_index.mean_energy()]), volatile=True)
+        return outputs, loss
+
+    def reset_checkpoint(self):
+        super().reset_checkpoint()
+        self.margin_index = None
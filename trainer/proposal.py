@@ -0,0 +1,94 @@
+import math
+import random
+from typing import List, Tuple
+
+import torch
+import torch.nn as nn
+
+from utils import named_parameters_binary, param_shape_2d
+
+
+class ProposalGenerator(object):
+    """
+    Draws the neuron indices of MCMC flips in bulk from a seeded torch.Generator and caches the binary
+    parameters of each model.
+    In the systematic scan mode, the sink and source neurons of every binary parameter are split into
+    randomly permuted groups of the flip size, and all `sink x source` blocks are visited in random order,
+    so that every connection is proposed once per scan.
+    """
+
+    def __init__(self, seed: int = None, stream_size=2 ** 16, systematic=False):
+        """
+        :param seed: generator seed; drawn from the `random` module if not set
+        :param stream_size: number of indices to pre-draw at once for each (size, k) pair
+        :param systematic: systematic scan instead of random blocks
+        """
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+        self.stream_size = stream_size
+        self.systematic = systematic
+        self.streams = {}
+        self.registry = {}
+        self.scan = []
+        self.scan_flip_ratio = None
+
+    def __repr__(self):
+        mode = "systematic scan" if self.systematic else "random blocks"
+        return f"{self.__class__.__name__}({mode})"
+
+    def named_parameters(self, model: nn.Module) -> List[Tuple[str, nn.Parameter]]:
+        """
+        :return: cached binary parameters of the model
+        """
+        named_params = self.registry.get(model, None)
+        if named_params is None:
+            named_params = named_parameters_binary(model)
+            self.registry[model] = named_params
+        return named_params
+
+    def sample(self, size: int, k: int) -> torch.LongTensor:
+        """
+        :return: `k` distinct random indices from range(size)
+        """
+        stream = self.streams.get((size, k), None)
+        if stream is None or stream[1] == len(stream[0]):
+            n_blocks = max(self.stream_size // size, 1)
+            blocks = torch.rand(n_blocks, size, generator=self.generator).topk(k, dim=1)[1]
+            stream = [blocks, 0]
+            self.streams[(size, k)] = stream
+        blocks, position = stream
+        stream[1] += 1
+        return blocks[position]
+
+    def sample_neurons(self, size: int, flip_ratio: float) -> torch.LongTensor:
+        return self.sample(size, k=math.ceil(size * flip_ratio))
+
+    def choose_parameter(self, model: nn.Module) -> Tuple[str, nn.Parameter]:
+        named_params = self.named_parameters(model)
+        return named_params[self.sample(len(named_params), k=1)[0]]
+
+    def build_scan(self, model: nn.Module, flip_ratio: float):
+        scan = []
+        for name, param in self.named_parameters(model):
+            size_output, size_input = param_shape_2d(param)
+            sink_groups = torch.randperm(size_output, generator=self.generator).split(
+                math.ceil(size_output * flip_ratio))
+            source_groups = torch.randperm(size_input, generator=self.generator).split(
+                math.ceil(size_input * flip_ratio))
+            scan.extend((name, source, sink) for sink in sink_groups for source in source_groups)
+        order = torch.randperm(len(scan), generator=self.generator)
+        self.scan = [scan[block_id] for block_id in order]
+        self.scan_flip_ratio = flip_ratio
+
+    def next_block(self, model: nn.Module, flip_ratio: float) -> Tuple[str, nn.Parameter, torch.LongTensor,
+                                                                      torch.LongTensor]:
+        """
+        :return: name, parameter, source and sink indices of the next block of the systematic scan
+        """
+        if len(self.scan) == 0 or flip_ratio != self.scan_flip_ratio:
+            self.build_scan(model, flip_ratio)
+        name, source, sink = self.scan.pop()
+        param = dict(self.named_parameters(model))[name]
+        return name, param, source, sink
@@ -0,0 +1,159 @@
+from typing import Callable, List
+
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
+
+from trainer.incremental import IncrementalForward
+from trainer.mcmc import per_sample_loss
+
+
+def sample_neuron_masks(size: int, flip_ratios: torch.DoubleTensor) -> torch.ByteTensor:
+    """
+    :param size: number of neurons
+    :param flip_ratios: flip ratio of each replica
+    :return: (n_replicas, size) masks of ceil(size * flip_ratio) random neurons of each replica
+    """
+    ranks = torch.rand(len(flip_ratios), size).sort(dim=1)[1].sort(dim=1)[1]
+    return ranks.double() < (flip_ratios * size).ceil().view(-1, 1)
+
+
+class ReplicaEngine(object):
+    """
+    Stores the binary weights of `n_replicas` copies of a model as stacked (n_replicas, out, in) tensors
+    and evaluates all of them in one batched forward pass.
+    Supports the same models as IncrementalForward.
+    """
+
+    def __init__(self, model: nn.Module, criterion: nn.Module, n_replicas: int):
+        """
+        :param model: binary model; only its structure and non-binary modules are used
+        :param criterion: loss function
+        :param n_replicas: number of model copies
+        """
+        self.model = model
+        self.criterion = criterion
+        self.n_replicas = n_replicas
+        self.evaluator = IncrementalForward(model)
+        self.weights = []
+
+    @property
+    def stages(self):
+        return self.evaluator.stages
+
+    def init(self, images: Variable):
+        """
+        Parses the model and copies its binary weights to all replicas.
+        """
+        self.evaluator.forward(images)
+        assert self.evaluator.is_supported and not any(stage.is_conv for stage in self.stages), \
+            "Only chains of binary linear layers are supported"
+        self.weights = [stage.weight.unsqueeze(0).repeat(self.n_replicas, 1, 1) for stage in self.stages]
+
+    def forward(self, images: Variable, weights: List[torch.FloatTensor]) -> torch.FloatTensor:
+        """
+        :param images: batch of input images, shared by all replicas
+        :param weights: stacked binary weights of each stage
+        :return: (n_replicas, batch_size, n_outputs) outputs
+        """
+        inputs = self.evaluator.forward_inputs(images)
+        batch_size = inputs.shape[0]
+        n_replicas = weights[0].shape[0]
+        x = torch.mm(inputs, weights[0].view(-1, weights[0].shape[-1]).t())
+        x = x.view(batch_size, n_replicas, -1).transpose(0, 1).contiguous()
+        for stage_id, (stage, weight) in enumerate(zip(self.stages, weights)):
+            if stage_id > 0:
+                x = stage.prepare_input(x.view(n_replicas * batch_size, -1)).view(n_replicas, batch_size, -1)
+                x = torch.bmm(x, weight.transpose(1, 2))
+            x = stage.forward_post(x.view(n_replicas * batch_size, -1)).view(n_replicas, batch_size, -1)
+        return x
+
+    def losses(self, outputs: torch.FloatTensor, labels: Variable) -> torch.FloatTensor:
+        """
+        :param outputs: (n_replicas, batch_size, n_outputs) outputs
+        :param labels: batch labels
+        :return: loss of each replica
+        """
+        try:
+            return per_sample_loss(self.criterion, outputs, labels.data).mean(dim=-1).cpu()
+        except NotImplementedError:
+            losses = [self.criterion(Variable(outputs_replica, volatile=True), labels).data[0]
+                      for outputs_replica in outputs]
+            return torch.FloatTensor(losses)
+
+    def propose(self, flip_ratios: List[float]) -> List[torch.FloatTensor]:
+        """
+        Flips a random block of a random layer in each replica; the blocks of all replicas are drawn at once.
+        :param flip_ratios: flip ratio of each replica
+        :return: proposed stacked weights
+        """
+        flip_ratios = torch.DoubleTensor(flip_ratios)  # same rounding of the block sizes as math.ceil
+        n_replicas = len(flip_ratios)
+        layer_chosen = torch.LongTensor(n_replicas).random_(0, len(self.weights))
+        weights_proposed = []
+        for layer_id, weight in enumerate(self.weights):
+            size_output, size_input = weight.shape[1:]
+            sink = sample_neuron_masks(size_output, flip_ratios)
+            source = sample_neuron_masks(size_input, flip_ratios)
+            is_chosen = (layer_chosen == layer_id).view(-1, 1, 1)
+            flipped = (sink.unsqueeze(2) & source.unsqueeze(1) & is_chosen).type_as(weight)
+            weights_proposed.append(weight * (1 - 2 * flipped))
+        return weights_proposed
+
+    def step(self, images: Variable, labels: Variable, flip_ratios: List[float], proba_accept: Callable):
+        """
+        One MCMC step of all replicas: the current and the proposed states are evaluated in one batched pass.
+        :param images: batch of input images
+        :param labels: batch labels
+        :param flip_ratios: flip ratio (temperature) of each replica
+        :param proba_accept: function (loss_delta, flip_ratios) -> acceptance probabilities
+        :return: outputs and losses of the replicas after the step
+        """
+        weights_proposed = self.propose(flip_ratios)
+        weights_all = [torch.cat([weight, weight_proposed], dim=0)
+                       for weight, weight_proposed in zip(self.weights, weights_proposed)]
+        outputs_all = self.forward(images, weights_all)
+        losses_all = self.losses(outputs_all, labels)
+        losses_orig, losses_proposed = losses_all[: self.n_replicas], losses_all[self.n_replicas:]
+        proba = proba_accept(losses_proposed - losses_orig, torch.FloatTensor(flip_ratios))
+        accepted = (torch.rand(self.n_replicas) < proba).nonzero()
+        if accepted.numel() > 0:
+            accepted = accepted.view(-1)
+            losses_orig.index_copy_(0, accepted, losses_proposed.index_select(0, accepted))
+            if outputs_all.is_cuda:
+                accepted = accepted.cuda()
+            for weight, weight_proposed in zip(self.weights, weights_proposed):
+                weight.index_copy_(0, accepted, weight_proposed.index_select(0, accepted))
+            outputs_all.index_copy_(0, accepted, outputs_all.index_select(0, accepted + self.n_replicas))
+        return outputs_all[: self.n_replicas], losses_orig
+
+    def resample(self, indices: torch.LongTensor):
+        """
+        Replaces the replicas by copies of the chosen ones, in place.
+        :param indices: (n_replicas,) source replica of each replica
+        """
+        if self.weights[0].is_cuda:
+            indices = indices.cuda()
+        for weight in self.weights:
+            weight.copy_(weight.index_select(0, indices))
+
+    def copy_replica(self, replica_id: int):
+        """
+        Appends a copy of the replica.
+        """
+        self.weights = [torch.cat([weight, weight[replica_id: replica_id + 1]], dim=0) for weight in self.weights]
+        self.n_replicas += 1
+
+    def delete_replica(self, replica_id: int):
+        replicas_kept = torch.LongTensor([other for other in range(self.n_replicas) if other != replica_id])
+        if self.weights[0].is_cuda:
+            replicas_kept = replicas_kept.cuda()
+        self.weights = [weight.index_select(0, replicas_kept) for weight in self.weights]
+        self.n_replicas -= 1
+
+    def load_replica(self, replica_id: int):
+        """
+        Copies the binary weights of a replica to the model.
+        """
+        for stage, weight in zip(self.stages, self.weights):
+            stage.weight.copy_(weight[replica_id])
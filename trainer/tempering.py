@@ -1,11 +1,22 @@
 import copy
 import math
+import os
+import queue
 import random
+import traceback
+from typing import List, Tuple, Union
 
+import torch
+import torch.multiprocessing
 import torch.nn as nn
+from torch.autograd import Variable
 
+from bitpack import PackedBits
 from layers import compile_inference
+from trainer.loss_cache import is_same_data
 from trainer.mcmc import TrainerMCMC
+from trainer.proposal import ProposalGenerator
+from trainer.replicas import ReplicaEngine
 from trainer.trainer import Trainer
 from utils import named_parameters_binary
 
@@ -19,47 +30,637 @@ def clone_model(model: nn.Module) -> nn.Module:
     return model_copied
 
 
+def flip_ratio_ladder(n_chains: int, flip_min=0.001, flip_max=0.9) -> List[float]:
+    """
+    :return: geometric ladder of flip ratios (temperatures between 0 and 1)
+    """
+    temperature_multiplier = math.pow(flip_max / flip_min, 1 / (n_chains - 1))
+    return [flip_min * temperature_multiplier ** chain_id for chain_id in range(n_chains)]
+
+
+class AdaptiveLadder(object):
+    """
+    Online tuning of a flip ratio ladder from the swap acceptance rates of neighbouring temperature slots.
+    Every `update_step` exchange sweeps, the log flip ratio gaps between neighbouring slots are scaled by
+    exp(gain * (rate - target)) and renormalized, so that the coldest and the hottest flip ratios stay fixed.
+    With `adapt_n_chains`, a chain is inserted in the middle of the worst pair if the mean rate is below target / 2,
+    or the intermediate chain with the highest rates of its pairs is removed if the mean rate is above
+    (1 + target) / 2.
+    """
+
+    def __init__(self, target=0.3, update_step=100, gain=1.0, adapt_n_chains=False, max_chains=32):
+        """
+        :param target: target swap acceptance rate of each pair of neighbouring slots
+        :param update_step: number of exchange sweeps between ladder updates
+        :param gain: step size of the log gap updates
+        :param adapt_n_chains: insert and remove chains?
+        :param max_chains: max number of chains if `adapt_n_chains` is set
+        """
+        self.target = target
+        self.update_step = update_step
+        self.gain = gain
+        self.adapt_n_chains = adapt_n_chains
+        self.max_chains = max_chains
+        self.swaps_accepted = []
+        self.swaps_attempted = []
+        self.sweeps = 0
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(target={self.target}, update_step={self.update_step}, " \
+               f"gain={self.gain}, adapt_n_chains={self.adapt_n_chains})"
+
+    def reset(self, n_chains: int):
+        self.swaps_accepted = [0] * (n_chains - 1)
+        self.swaps_attempted = [0] * (n_chains - 1)
+        self.sweeps = 0
+
+    def record(self, swapped: List[Union[bool, None]]):
+        """
+        :param swapped: swap outcome of each pair of neighbouring slots in one exchange sweep;
+                        None if the swap was not attempted
+        """
+        for slot, is_swapped in enumerate(swapped):
+            if is_swapped is not None:
+                self.swaps_accepted[slot] += int(is_swapped)
+                self.swaps_attempted[slot] += 1
+        self.sweeps += 1
+
+    def is_due(self) -> bool:
+        return self.sweeps >= self.update_step
+
+    def rates(self) -> List[float]:
+        """
+        :return: swap acceptance rate of each pair of neighbouring slots
+        """
+        return [accepted / max(attempted, 1)
+                for accepted, attempted in zip(self.swaps_accepted, self.swaps_attempted)]
+
+    def tune(self, flip_ratios: List[float]) -> List[float]:
+        """
+        :param flip_ratios: current ladder, from cold to hot
+        :return: new ladder with the same end points
+        """
+        log_ratios = [math.log(flip_ratio) for flip_ratio in flip_ratios]
+        gaps = [log_hot - log_cold for log_cold, log_hot in zip(log_ratios[:-1], log_ratios[1:])]
+        gaps = [gap * math.exp(self.gain * (rate - self.target)) for gap, rate in zip(gaps, self.rates())]
+        gap_scale = (log_ratios[-1] - log_ratios[0]) / sum(gaps)
+        flip_ratios_tuned = [flip_ratios[0]]
+        log_ratio = log_ratios[0]
+        for gap in gaps[:-1]:
+            log_ratio += gap * gap_scale
+            flip_ratios_tuned.append(math.exp(log_ratio))
+        flip_ratios_tuned.append(flip_ratios[-1])
+        return flip_ratios_tuned
+
+    def resize(self, n_chains: int) -> Union[Tuple[str, int], None]:
+        """
+        :return: ('insert', slot) to insert a chain after the slot, ('remove', slot) to remove the chain
+                 at the slot, or None
+        """
+        if not self.adapt_n_chains:
+            return None
+        rates = self.rates()
+        rate_mean = sum(rates) / len(rates)
+        if rate_mean < self.target / 2 and n_chains < self.max_chains:
+            slot_worst = min(range(len(rates)), key=lambda slot: rates[slot])
+            return 'insert', slot_worst
+        if rate_mean > (1 + self.target) / 2 and n_chains > 2:
+            slot_redundant = max(range(1, n_chains - 1), key=lambda slot: rates[slot - 1] + rates[slot])
+            return 'remove', slot_redundant
+        return None
+
+
+class RoundTripTracker(object):
+    """
+    Tracks the round trips of each chain from the coldest temperature slot to the hottest one and back.
+    """
+
+    def __init__(self, n_chains: int):
+        self.sweeps = 0
+        self.round_trips = 0
+        self.round_trip_sweeps = 0
+        self.direction = [0] * n_chains  # +1 after a visit of the coldest slot, -1 after the hottest one
+        self.start_sweep = [0] * n_chains  # sweep of the last visit of the coldest slot
+
+    def add_chain(self):
+        self.direction.append(0)
+        self.start_sweep.append(self.sweeps)
+
+    def delete_chain(self, chain_id: int):
+        del self.direction[chain_id]
+        del self.start_sweep[chain_id]
+
+    def update(self, chain_at_slot: List[int]):
+        """
+        :param chain_at_slot: chain id at each temperature slot after an exchange sweep
+        """
+        self.sweeps += 1
+        chain_cold, chain_hot = chain_at_slot[0], chain_at_slot[-1]
+        if self.direction[chain_cold] == -1:
+            self.round_trips += 1
+            self.round_trip_sweeps += self.sweeps - self.start_sweep[chain_cold]
+        if self.direction[chain_cold] != 1:
+            self.direction[chain_cold] = 1
+            self.start_sweep[chain_cold] = self.sweeps
+        if self.direction[chain_hot] == 1:
+            self.direction[chain_hot] = -1
+
+    def get_round_trip_rate(self) -> float:
+        """
+        :return: completed round trips per exchange sweep
+        """
+        return self.round_trips / max(self.sweeps, 1)
+
+    def get_round_trip_time(self) -> float:
+        """
+        :return: mean number of exchange sweeps of a round trip
+        """
+        if self.round_trips == 0:
+            return float('nan')
+        return self.round_trip_sweeps / self.round_trips
+
+
 class ParallelTempering(Trainer):
     def __init__(self, model: nn.Module, criterion: nn.Module, dataset_name: str, trainer_cls=TrainerMCMC,
-                 n_chains=5, **kwargs):
-        compile_inference(model)
+                 trainer_kwargs=dict(), n_chains=5, adaptive_ladder=False, ladder_kwargs=dict(), **kwargs):
+        """
+        :param trainer_cls: MCMC trainer class of the chains
+        :param trainer_kwargs: chain trainer arguments
+        :param n_chains: number of chains (temperature slots)
+        :param adaptive_ladder: tune the flip ratio ladder from the swap acceptance rates?
+        :param ladder_kwargs: AdaptiveLadder arguments
+        """
+        compile_inference(model, keep_batch_norm=True)
         super().__init__(model=model, criterion=criterion, dataset_name=dataset_name, **kwargs)
         self.monitor.log(f"Parallel tempering chain trainer: {trainer_cls.__name__}")
-        flip_min = 0.001
-        flip_max = 0.9
-        temperature_multiplier = math.pow(flip_max / flip_min, 1 / (n_chains - 1))
-        flip_ratio_chains = []
+        self.trainer_cls = trainer_cls
+        self.trainer_kwargs = trainer_kwargs
+        self.n_chains = n_chains
+        self.flip_ratios = flip_ratio_ladder(n_chains)
+        self.chain_at_slot = list(range(n_chains))  # chain id at each temperature slot
+        self.round_trips = RoundTripTracker(n_chains)
+        self.ladder = None
+        if adaptive_ladder:
+            self.ladder = AdaptiveLadder(**ladder_kwargs)
+            self.ladder.reset(n_chains)
+            self.monitor.log(repr(self.ladder))
+        self.init_chains(model)
+        # the proposal generator of each temperature slot, so that a systematic scan continues at the slot
+        # regardless of the chain swapped into it
+        self.proposals = {trainer.flip_ratio: trainer.proposal for trainer in self.chain_trainers()}
+        self.monitor.log(f"Started {n_chains} chains with flip ratios (temperatures between 0 and 1): "
+                         f"{self.flip_ratios}")
+        self._monitor_functions()
+
+    def init_chains(self, model: nn.Module):
         self.trainers = []
-        for trainer_id in range(n_chains):
-            flip_ratio = flip_min * temperature_multiplier ** trainer_id
-            flip_ratio_chains.append(flip_ratio)
-            trainer = trainer_cls(model=model, criterion=self.criterion,
-                                  dataset_name=self.dataset_name, flip_ratio=flip_ratio,
-                                  monitor_kwargs=dict(is_active=False, watch_parameters=False))
+        for flip_ratio in self.flip_ratios:
+            trainer = self.trainer_cls(model=model, criterion=self.criterion, dataset_name=self.dataset_name,
+                                       flip_ratio=flip_ratio, parent=self, **self.trainer_kwargs)
             self.trainers.append(trainer)
             model = clone_model(model)
-        self.monitor.log(f"Started {n_chains} chains with flip ratios (temperatures between 0 and 1): "
-                         f"{flip_ratio_chains}")
+
+    def copy_chain(self, chain_id: int):
+        """
+        Appends a copy of the chain with a new chain id.
+        """
+        model = clone_model(self.trainers[chain_id].model)
+        trainer = self.trainer_cls(model=model, criterion=self.criterion, dataset_name=self.dataset_name,
+                                   flip_ratio=self.trainers[chain_id].flip_ratio, parent=self, **self.trainer_kwargs)
+        self.trainers.append(trainer)
+
+    def delete_chain(self, chain_id: int):
+        """
+        Deletes the chain; the ids of the next chains are decremented.
+        """
+        del self.trainers[chain_id]
+
+    def get_proposal(self, flip_ratio: float) -> ProposalGenerator:
+        """
+        :return: proposal generator of the temperature slot with the flip ratio
+        """
+        proposal = self.proposals.get(flip_ratio, None)
+        if proposal is None:
+            proposal_base = self.chain_trainers()[0].proposal
+            proposal = ProposalGenerator(stream_size=proposal_base.stream_size, systematic=proposal_base.systematic)
+            self.proposals[flip_ratio] = proposal
+        return proposal
+
+    def prune_proposals(self):
+        """
+        Drops the proposal generators of the flip ratios, replaced by the ladder tuning.
+        """
+        self.proposals = {flip_ratio: self.proposals[flip_ratio] for flip_ratio in self.flip_ratios
+                          if flip_ratio in self.proposals}
+
+    def apply_flip_ratios(self):
+        """
+        Passes the flip ratios of the ladder to the chains, together with the proposal generators of their slots.
+        """
+        self.prune_proposals()
+        for chain_id, flip_ratio in enumerate(self.chain_flip_ratios()):
+            self.trainers[chain_id].flip_ratio = flip_ratio
+            self.trainers[chain_id].proposal = self.get_proposal(flip_ratio)
+
+    def ladder_step(self):
+        """
+        Updates the flip ratio ladder, and possibly the number of chains, once enough swaps are recorded.
+        """
+        if self.ladder is None or not self.ladder.is_due():
+            return
+        rates = self.ladder.rates()
+        self.flip_ratios = self.ladder.tune(self.flip_ratios)
+        resize = self.ladder.resize(self.n_chains)
+        if resize is not None:
+            action, slot = resize
+            if action == 'insert':
+                self.copy_chain(self.chain_at_slot[slot])
+                self.round_trips.add_chain()
+                self.chain_at_slot.insert(slot + 1, self.n_chains)
+                self.flip_ratios.insert(slot + 1, math.sqrt(self.flip_ratios[slot] * self.flip_ratios[slot + 1]))
+                self.n_chains += 1
+            else:
+                chain_id = self.chain_at_slot.pop(slot)
+                self.delete_chain(chain_id)
+                self.round_trips.delete_chain(chain_id)
+                self.chain_at_slot = [chain_other - int(chain_other > chain_id)
+                                      for chain_other in self.chain_at_slot]
+                self.flip_ratios.pop(slot)
+                self.n_chains -= 1
+        self.ladder.reset(self.n_chains)
+        self.apply_flip_ratios()
+        self.monitor.log(f"Swap acceptance rates: {[round(rate, 3) for rate in rates]}. "
+                         f"New ladder of {self.n_chains} chains: {self.flip_ratios}")
 
     @staticmethod
     def to_temperature(flip_ratio):
         return flip_ratio * math.log(10)
 
+    def proba_swap(self, loss_cold: float, loss_hot: float, flip_ratio_cold: float, flip_ratio_hot: float) -> float:
+        """
+        :return: replica exchange acceptance probability min(1, exp((1/T_cold - 1/T_hot) * (E_cold - E_hot)))
+        """
+        beta_diff = 1 / self.to_temperature(flip_ratio_cold) - 1 / self.to_temperature(flip_ratio_hot)
+        return math.exp(min(beta_diff * (loss_cold - loss_hot), 0.))
+
+    def exchange_replicas(self, losses: List[float]):
+        """
+        Non-reversible replica exchange: swaps are attempted between even slot pairs (0-1, 2-3, ...) and odd
+        slot pairs (1-2, 3-4, ...) in alternating sweeps, after all chains have made their step.
+        Swaps temperature assignments of chains.
+        :param losses: loss of each chain
+        """
+        parity = self.round_trips.sweeps % 2
+        swapped = [None] * (self.n_chains - 1)
+        for slot in range(parity, self.n_chains - 1, 2):
+            chain_cold, chain_hot = self.chain_at_slot[slot], self.chain_at_slot[slot + 1]
+            proba_swap = self.proba_swap(loss_cold=losses[chain_cold], loss_hot=losses[chain_hot],
+                                         flip_ratio_cold=self.flip_ratios[slot],
+                                         flip_ratio_hot=self.flip_ratios[slot + 1])
+            swapped[slot] = random.random() < proba_swap
+            if swapped[slot]:
+                self.chain_at_slot[slot], self.chain_at_slot[slot + 1] = chain_hot, chain_cold
+        self.round_trips.update(self.chain_at_slot)
+        if self.ladder is not None:
+            self.ladder.record(swapped)
+
+    def chain_trainers(self) -> List[TrainerMCMC]:
+        """
+        :return: MCMC trainers of the chains
+        """
+        return self.trainers
+
+    def get_loss_cache_hit_rate(self) -> float:
+        """
+        :return: loss cache hits / lookups of all chains
+        """
+        caches = [trainer.loss_cache for trainer in self.chain_trainers() if trainer.loss_cache is not None]
+        return sum(cache.hits for cache in caches) / max(sum(cache.lookups for cache in caches), 1)
+
+    def chain_flip_ratios(self) -> List[float]:
+        """
+        :return: flip ratio (temperature) of each chain
+        """
+        flip_ratios = [None] * self.n_chains
+        for slot, chain_id in enumerate(self.chain_at_slot):
+            flip_ratios[chain_id] = self.flip_ratios[slot]
+        return flip_ratios
+
+    def train_batch(self, images, labels):
+        self.ladder_step()
+        results = [trainer.train_batch(images, labels) for trainer in self.trainers]
+        losses = [loss.data[0] for outputs, loss in results]
+        self.exchange_replicas(losses)
+        self.apply_flip_ratios()
+        best_chain = min(range(self.n_chains), key=lambda chain_id: losses[chain_id])
+        self.model = self.trainers[best_chain].model
+        return results[best_chain]
+
+    def _monitor_functions(self):
+        self.monitor.register_func(self.round_trips.get_round_trip_rate, opts=dict(
+            xlabel='Epoch',
+            ylabel='Round trips / sweep',
+            title='Parallel tempering round trip rate'
+        ))
+        self.monitor.register_func(self.round_trips.get_round_trip_time, opts=dict(
+            xlabel='Epoch',
+            ylabel='Sweeps',
+            title='Parallel tempering mean round trip time'
+        ))
+        if any(trainer.loss_cache is not None for trainer in self.chain_trainers()):
+            self.monitor.register_func(self.get_loss_cache_hit_rate, opts=dict(
+                xlabel='Epoch',
+                ylabel='Hit rate',
+                title='MCMC loss cache hits / lookups of all chains'
+            ))
+
+
+class ParallelTemperingVectorized(ParallelTempering):
+    """
+    Parallel tempering with the binary weights of all chains stacked in a ReplicaEngine.
+    Current and proposed states of every chain are evaluated in one batched forward pass;
+    a replica exchange swaps the flip ratios (temperatures) of two chains instead of their weights.
+    """
+
+    def init_chains(self, model: nn.Module):
+        self.engine = ReplicaEngine(model, criterion=self.criterion, n_replicas=self.n_chains)
+
+    def chain_trainers(self) -> List[TrainerMCMC]:
+        return []
+
+    def copy_chain(self, chain_id: int):
+        self.engine.copy_replica(chain_id)
+
+    def delete_chain(self, chain_id: int):
+        self.engine.delete_replica(chain_id)
+
+    def apply_flip_ratios(self):
+        pass
+
+    def train_batch(self, images, labels):
+        self.ladder_step()
+        if len(self.engine.weights) == 0:
+            self.engine.init(images)
+        outputs, losses = self.engine.step(images, labels, flip_ratios=self.chain_flip_ratios(),
+                                           proba_accept=self.trainer_cls.accept_vector)
+        self.exchange_replicas(losses)
+        best_chain = min(range(self.n_chains), key=lambda chain_id: losses[chain_id])
+        self.engine.load_replica(best_chain)
+        best_outputs = Variable(outputs[best_chain], volatile=True)
+        return best_outputs, self.criterion(best_outputs, labels)
+
+
+class ParallelTemperingPacked(ParallelTempering):
+    """
+    Parallel tempering with a single float model and chain trainer, shared by all chains. The binary weights of
+    each chain are kept packed (1 bit per weight) and unpacked into the model for the chain's MCMC step; the
+    accepted flips of the step are then applied to the packed bits. The acceptance counters of the trainer are kept
+    per chain, and its proposal generator per flip ratio of the ladder, so that a systematic scan continues at the
+    temperature slot regardless of the chain swapped into it.
+    A replica exchange swaps the flip ratios (temperatures) of two chains.
+    The chain trainer must not cache model state between batches (as TrainerMCMCFullData does).
+    """
+
+    chain_attributes = ('accepted_count', 'update_calls', 'hash_current')
+
+    def init_chains(self, model: nn.Module):
+        self.trainer = self.trainer_cls(model=model, criterion=self.criterion, dataset_name=self.dataset_name,
+                                        flip_ratio=self.flip_ratios[0], parent=self, **self.trainer_kwargs)
+        self.named_params = named_parameters_binary(model)
+        self.chains = [{name: PackedBits(param.data) for name, param in self.named_params}
+                       for chain_id in range(self.n_chains)]
+        self.chain_states = [self.new_chain_state() for chain_id in range(self.n_chains)]
+        n_bytes = sum(bits.nbytes for chain in self.chains for bits in chain.values())
+        self.monitor.log(f"Packed binary weights of all chains: {n_bytes} B")
+
+    def new_chain_state(self) -> dict:
+        """
+        :return: chain trainer attributes of a new chain
+        """
+        return dict(accepted_count=0, update_calls=0, hash_current=None)
+
+    def chain_trainers(self) -> List[TrainerMCMC]:
+        return [self.trainer]
+
+    def copy_chain(self, chain_id: int):
+        self.load_chain(chain_id)
+        self.chains.append({name: PackedBits(param.data) for name, param in self.named_params})
+        self.chain_states.append(self.new_chain_state())
+
+    def delete_chain(self, chain_id: int):
+        del self.chains[chain_id]
+        del self.chain_states[chain_id]
+
+    def apply_flip_ratios(self):
+        pass
+
+    def load_chain(self, chain_id: int):
+        for name, param in self.named_params:
+            self.chains[chain_id][name].unpack_into(param.data)
+        for attribute, value in self.chain_states[chain_id].items():
+            setattr(self.trainer, attribute, value)
+
+    def save_chain(self, chain_id: int):
+        """
+        Saves the trainer state and the flips, accepted since load_chain, of the chain.
+        """
+        for attribute in self.chain_attributes:
+            self.chain_states[chain_id][attribute] = getattr(self.trainer, attribute)
+        if self.trainer.flips_accepted is None:
+            # the trainer didn't report its flips
+            for name, param in self.named_params:
+                self.chains[chain_id][name].pack(param.data)
+            return
+        for pflip in self.trainer.flips_accepted:
+            self.chains[chain_id][pflip.name].flip(pflip.get_idx_flipped())
+
+    def train_batch(self, images, labels):
+        self.ladder_step()
+        self.prune_proposals()
+        flip_ratios = self.chain_flip_ratios()
+        results = []
+        for chain_id, flip_ratio in enumerate(flip_ratios):
+            self.load_chain(chain_id)
+            self.trainer.flip_ratio = flip_ratio
+            self.trainer.proposal = self.get_proposal(flip_ratio)
+            self.trainer.flips_accepted = None
+            results.append(self.trainer.train_batch(images, labels))
+            self.save_chain(chain_id)
+        losses = [loss.data[0] for outputs, loss in results]
+        self.exchange_replicas(losses)
+        best_chain = min(range(self.n_chains), key=lambda chain_id: losses[chain_id])
+        self.load_chain(best_chain)
+        return results[best_chain]
+
+
+def chain_worker(worker_id: int, trainers: dict, flip_ratios: torch.FloatTensor, images: torch.FloatTensor,
+                 labels: torch.LongTensor, tasks: torch.multiprocessing.Queue, results: torch.multiprocessing.Queue):
+    """
+    Runs the chains of one worker process. Weights, flip ratios and the batch live in shared memory;
+    each task is the (batch id, batch size) pair, and only scalar losses (and loss cache counters) are sent back.
+    The worker keeps a proposal generator per flip ratio, passed to the chain at that temperature slot, so that
+    a systematic scan continues at the slot regardless of the chain swapped into it.
+    A failure is sent back as a (None, traceback, None) result.
+    :param worker_id: worker id
+    :param trainers: dict of chain id -> chain trainer with shared memory weights
+    """
+    try:
+        random.seed(os.getpid())
+        torch.manual_seed(os.getpid())
+        torch.set_num_threads(1)
+        proposal_base = next(iter(trainers.values())).proposal
+        proposals = {}
+        batch_id_copied = None
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            batch_id, batch_size = task
+            if batch_id != batch_id_copied:
+                # a copy of the batch: the shared buffers are overwritten in-place by the next batch, while
+                # the loss caches of the chains are kept as long as the batch tensors are the same
+                images_batch = Variable(images[: batch_size].clone(), volatile=True)
+                labels_batch = Variable(labels[: batch_size].clone(), volatile=True)
+                batch_id_copied = batch_id
+            chain_flip_ratios = flip_ratios.tolist()
+            # drop the proposals of the flip ratios, replaced by the ladder tuning
+            proposals = {flip_ratio: proposals[flip_ratio] for flip_ratio in chain_flip_ratios
+                         if flip_ratio in proposals}
+            for chain_id, trainer in trainers.items():
+                trainer.flip_ratio = chain_flip_ratios[chain_id]
+                if trainer.flip_ratio not in proposals:
+                    # seeded in the worker: the streams forked from the coordinator would repeat after a restart
+                    proposals[trainer.flip_ratio] = ProposalGenerator(stream_size=proposal_base.stream_size,
+                                                                      systematic=proposal_base.systematic)
+                trainer.proposal = proposals[trainer.flip_ratio]
+                outputs, loss = trainer.train_batch(images_batch, labels_batch)
+                cache_counts = None
+                if trainer.loss_cache is not None:
+                    cache_counts = (trainer.loss_cache.hits, trainer.loss_cache.lookups)
+                results.put((chain_id, loss.data[0], cache_counts))
+    except Exception:
+        results.put((None, f"Worker {worker_id} failed:\n{traceback.format_exc()}", None))
+
+
+class ParallelTemperingProcesses(ParallelTempering):
+    """
+    Parallel tempering with chains distributed among worker processes (CPU only).
+    Each worker runs the `train_batch` of its chain trainers; binary weights live in shared memory, and
+    a replica exchange swaps the flip ratios (temperatures) of two chains.
+    """
+
+    def __init__(self, model: nn.Module, criterion: nn.Module, dataset_name: str, n_workers: int = None,
+                 timeout=600, **kwargs):
+        """
+        :param n_workers: number of worker processes; defaults to min(n_chains, cpu_count)
+        :param timeout: max number of seconds to wait for a chain step
+        """
+        self.n_workers = n_workers
+        self.timeout = timeout
+        super().__init__(model, criterion, dataset_name, **kwargs)
+
+    def init_chains(self, model: nn.Module):
+        if self.n_workers is None:
+            self.n_workers = min(self.n_chains, os.cpu_count())
+        # self.model receives the best chain after each step, so it must not be the weights of a chain
+        super().init_chains(clone_model(model))
+        for trainer in self.trainers:
+            trainer.model.share_memory()
+        self.flip_ratios_shared = None
+        self.images_shared = None
+        self.labels_shared = None
+        self.batch = None
+        self.batch_id = 0
+        self.workers = []
+
+    def copy_chain(self, chain_id: int):
+        self.close()
+        super().copy_chain(chain_id)
+        self.trainers[-1].model.share_memory()
+
+    def delete_chain(self, chain_id: int):
+        self.close()
+        super().delete_chain(chain_id)
+
+    def start_workers(self, images: torch.FloatTensor, labels: torch.LongTensor):
+        self.flip_ratios_shared = torch.FloatTensor(self.chain_flip_ratios()).share_memory_()
+        self.images_shared = images.clone().share_memory_()
+        self.labels_shared = labels.clone().share_memory_()
+        context = torch.multiprocessing.get_context('fork')
+        self.results = context.Queue()
+        self.workers = []
+        for worker_id in range(self.n_workers):
+            trainers = {chain_id: self.trainers[chain_id]
+                        for chain_id in range(worker_id, self.n_chains, self.n_workers)}
+            tasks = context.Queue()
+            process = context.Process(target=chain_worker, args=(
+                worker_id, trainers, self.flip_ratios_shared, self.images_shared, self.labels_shared,
+                tasks, self.results), daemon=True)
+            process.start()
+            self.workers.append((process, tasks))
+
+    def close(self):
+        for process, tasks in self.workers:
+            if process.is_alive():
+                tasks.put(None)
+        for process, tasks in self.workers:
+            process.join(timeout=self.timeout)
+            if process.is_alive():
+                process.terminate()
+        self.workers = []
+
+    def get_result(self) -> Tuple[int, float]:
+        """
+        Waits for the loss of a chain, while checking that the workers are alive.
+        The loss cache counters of the chain trainer are updated from the worker.
+        :return: chain id and its loss after the step
+        """
+        time_waited = 0
+        while True:
+            try:
+                chain_id, loss, cache_counts = self.results.get(timeout=1)
+                break
+            except queue.Empty:
+                time_waited += 1
+                exit_codes = [process.exitcode for process, tasks in self.workers if not process.is_alive()]
+                if len(exit_codes) > 0:
+                    self.close()
+                    raise RuntimeError(f"{len(exit_codes)} worker(s) exited unexpectedly with codes {exit_codes}")
+                if time_waited >= self.timeout:
+                    self.close()
+                    raise TimeoutError(f"No chain step finished in {self.timeout} seconds")
+        if chain_id is None:
+            self.close()
+            raise RuntimeError(loss)
+        if cache_counts is not None:
+            loss_cache = self.trainers[chain_id].loss_cache
+            loss_cache.hits, loss_cache.lookups = cache_counts
+        return chain_id, loss
+
     def train_batch(self, images, labels):
-        best_outputs, best_loss = self.trainers[0].train_batch(images, labels)
-        prev_loss = best_loss
-        for trainer_prev, trainer in zip(self.trainers[:-1], self.trainers[1:]):
-            outputs, loss = trainer.train_batch(images, labels)
-            if loss.data[0] < best_loss.data[0]:
-                best_loss = loss
-                best_outputs = outputs
-                self.model = trainer.model
-            energy_diff = loss.data[0] - prev_loss.data[0]
-            temperature_curr = self.to_temperature(trainer.flip_ratio)
-            temperature_prev = self.to_temperature(trainer_prev.flip_ratio)
-            proba_swap = math.exp(energy_diff / (1 / temperature_curr - 1 / temperature_prev))
-            if random.random() < proba_swap:
-                model_curr = trainer.model
-                trainer.model = trainer_prev.model
-                trainer_prev.model = model_curr
-        return best_outputs, best_loss
+        self.ladder_step()
+        images_batch, labels_batch = images.data.cpu(), labels.data.cpu()
+        batch_size = len(labels_batch)
+        is_new_batch = self.batch is None or not is_same_data(self.batch, (images_batch, labels_batch))
+        if len(self.workers) == 0 or batch_size > len(self.labels_shared):
+            self.close()
+            self.start_workers(images_batch, labels_batch)
+            is_new_batch = True
+        if is_new_batch:
+            # the batch tensors are kept so that their memory isn't reused by the next batch
+            self.batch = (images_batch, labels_batch)
+            self.batch_id += 1
+            self.images_shared[: batch_size].copy_(images_batch)
+            self.labels_shared[: batch_size].copy_(labels_batch)
+        self.flip_ratios_shared.copy_(torch.FloatTensor(self.chain_flip_ratios()))
+        for process, tasks in self.workers:
+            tasks.put((self.batch_id, batch_size))
+        losses = [None] * self.n_chains
+        for _ in range(self.n_chains):
+            chain_id, loss = self.get_result()
+            losses[chain_id] = loss
+        self.exchange_replicas(losses)
+        best_chain = min(range(self.n_chains), key=lambda chain_id: losses[chain_id])
+        self.model.load_state_dict(self.trainers[best_chain].model.state_dict())
+        outputs = self.model(images)
+        return outputs, self.criterion(outputs, labels)
@@ -10,7 +10,7 @@ from tqdm import tqdm
 from constants import MODELS_DIR
 from monitor.monitor import Monitor
 from monitor.accuracy import calc_accuracy, argmax_accuracy, get_outputs
-from utils import get_data_loader, load_model_state
+from utils import get_data_loader, load_model_state, ResidentLoader
 from layers import ScaleLayer
 from trainer.checkpoint import Checkpoint
 
@@ -18,15 +18,28 @@ from trainer.checkpoint import Checkpoint
 class Trainer(ABC):
 
     def __init__(self, model: nn.Module, criterion: nn.Module, dataset_name: str, monitor_cls: type = Monitor,
-                 patience=None, monitor_kwargs=dict()):
+                 patience=None, monitor_kwargs=dict(), loader_kwargs=dict(), parent: 'Trainer' = None):
+        """
+        :param loader_kwargs: get_data_loader arguments (e.g. packed_signs=True) of the train, eval and test loaders
+        :param parent: trainer that runs this one as a sub-chain (e.g. ParallelTempering);
+                       its train loader, monitor and checkpoint are shared instead of creating new ones
+        """
         self.model = model
         self.criterion = criterion
         self.dataset_name = dataset_name
-        self.train_loader = get_data_loader(dataset_name, train=True)
-        self.monitor = monitor_cls(self, **monitor_kwargs)
-        self._monitor_parameters(self.model)
+        self.parent = parent
+        if parent is None:
+            self.loader_kwargs = loader_kwargs
+            self.train_loader = get_data_loader(dataset_name, train=True, **loader_kwargs)
+            self.monitor = monitor_cls(self, **monitor_kwargs)
+            self._monitor_parameters(self.model)
+            self.checkpoint = Checkpoint(model=self.model, patience=patience)
+        else:
+            self.loader_kwargs = parent.loader_kwargs
+            self.train_loader = parent.train_loader
+            self.monitor = parent.monitor
+            self.checkpoint = parent.checkpoint
         self.volatile = False
-        self.checkpoint = Checkpoint(model=self.model, patience=patience)
 
     def save_model(self, accuracy: float = None):
         model_path = MODELS_DIR.joinpath(self.dataset_name, self.model.__class__.__name__).with_suffix('.pt')
@@ -62,6 +75,13 @@ class Trainer(ABC):
         if isinstance(model, (nn.Linear, nn.Conv2d, ScaleLayer)):
             self.monitor.register_layer(model, prefix=prefix.lstrip('.'))
 
+    def get_outputs_full(self, eval_loader: torch.utils.data.DataLoader):
+        """
+        :param eval_loader: full train set loader without shuffling
+        :return: model outputs and labels of the full train set
+        """
+        return get_outputs(self.model, eval_loader)
+
     @abstractmethod
     def train_batch(self, images, labels):
         raise NotImplementedError()
@@ -91,10 +111,8 @@ class Trainer(ABC):
         print(f"Training '{self.model.__class__.__name__}'. "
               f"Best {self.dataset_name} train accuracy so far: {best_accuracy:.4f}")
 
-        eval_loader = torch.utils.data.DataLoader(dataset=self.train_loader.dataset,
-                                                  batch_size=self.train_loader.batch_size,
-                                                  shuffle=False,
-                                                  num_workers=self.train_loader.num_workers)
+        eval_loader = ResidentLoader(get_data_loader(self.dataset_name, train=True,
+                                                     **dict(self.loader_kwargs, shuffle=False)))
 
         if with_mutual_info:
             global get_outputs
@@ -120,9 +138,11 @@ class Trainer(ABC):
                 # self.monitor.update_accuracy(argmax_accuracy(outputs, labels), mode='batch')
 
             if epoch % epoch_update_step == 0:
+                # some trainers evaluate only the first samples of a batch
+                labels = labels[: len(outputs)]
                 self.monitor.update_loss(loss=loss.data[0], mode='batch')
                 self.monitor.update_accuracy(argmax_accuracy(outputs, labels), mode='batch')
-                outputs_full, labels_full = get_outputs(self.model, eval_loader)
+                outputs_full, labels_full = self.get_outputs_full(eval_loader)
                 accuracy = argmax_accuracy(outputs_full, labels_full)
                 self.monitor.update_accuracy(accuracy, mode='full train')
                 if accuracy > best_accuracy:
@@ -2,13 +2,17 @@ import math
 from functools import lru_cache
 from tqdm import tqdm
 from pathlib import Path
-from typing import Union
+from typing import Union, Tuple
 
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.utils.data
+from torch.autograd import Variable
 from torchvision import transforms, datasets
 
+from bitpack import pack_signs_bytes
 from constants import DATA_DIR, MODELS_DIR
 from monitor.var_online import dataset_mean_std
 
@@ -39,6 +43,15 @@ def named_parameters_binary(model: nn.Module):
     return [(name, param) for name, param in model.named_parameters() if is_binary(param)]
 
 
+def param_shape_2d(param: nn.Parameter) -> Tuple[int, int]:
+    """
+    :return: (out, in) shape of the parameter viewed as a matrix; conv weights are viewed as
+             (out_channels, in_channels * kernel_height * kernel_width)
+    """
+    size_output = param.data.shape[0]
+    return size_output, param.data.numel() // size_output
+
+
 def find_param_by_name(model: nn.Module, name_search: str) -> Union[nn.Parameter, None]:
     for name, param in model.named_parameters():
         if name == name_search:
@@ -52,25 +65,225 @@ def has_binary_params(layer: nn.Module):
     return all(map(is_binary, layer.parameters()))
 
 
-def get_data_loader(dataset: str, train=True, batch_size=256) -> torch.utils.data.DataLoader:
-    transform_list = []
-    if dataset == "MNIST":
-        dataset_cls = datasets.MNIST
-        transform_list.append(transforms.ToTensor())
-        transform_list.append(NormalizeFromDataset(dataset_cls=dataset_cls))
+def get_data_loader(dataset: str, train=True, batch_size=256, shuffle=True, packed_signs=False):
+    """
+    :param dataset: dataset name
+    :param train: train or test set?
+    :param batch_size: batch size
+    :param shuffle: shuffle the samples at each epoch?
+    :param packed_signs: yield bit-packed input signs (PackedSignsDataset) instead of float images;
+                         the first binary layer of the model must be linear
+    :return: MNIST and CIFAR10 are read from the preprocessed memory-mapped arrays (MemmapLoader);
+             other datasets are served by torch DataLoader
+    """
+    if dataset in ("MNIST", "CIFAR10"):
+        dataset_cls = PackedSignsDataset if packed_signs else PreprocessedDataset
+        dataset = dataset_cls(dataset, train=train)
+        return MemmapLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+    elif packed_signs:
+        raise NotImplementedError(f"Bit-packed inputs are not supported for {dataset}")
     elif dataset == "MNIST56":
-        dataset_cls = MNIST56
-    elif dataset == "CIFAR10":
-        dataset_cls = datasets.CIFAR10
-        transform_list.append(transforms.ToTensor())
-        transform_list.append(NormalizeFromDataset(dataset_cls=dataset_cls))
+        dataset = MNIST56(DATA_DIR, train=train)
     else:
         raise NotImplementedError()
-    dataset = dataset_cls(DATA_DIR, train=train, download=True, transform=transforms.Compose(transform_list))
-    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=4)
     return loader
 
 
+class PreprocessedDataset(torch.utils.data.Dataset):
+    """
+    Torchvision dataset, normalized once and stored as memory-mapped .npy arrays in DATA_DIR.
+    """
+
+    def __init__(self, dataset_name: str, train=True):
+        """
+        :param dataset_name: 'MNIST' or 'CIFAR10'
+        :param train: train or test set?
+        """
+        self.dataset_name = dataset_name
+        self.train = train
+        images_path, labels_path = self.get_data_paths()
+        if not labels_path.exists():
+            self.preprocess()
+        self.images = np.load(images_path, mmap_mode='r')
+        self.labels = np.load(labels_path)
+
+    def get_data_paths(self) -> Tuple[Path, Path]:
+        fold = 'train' if self.train else 'test'
+        data_dir = DATA_DIR.joinpath('preprocessed', self.dataset_name)
+        return data_dir.joinpath(f'{fold}_images.npy'), data_dir.joinpath(f'{fold}_labels.npy')
+
+    def preprocess(self):
+        dataset_cls = getattr(datasets, self.dataset_name)
+        transform = transforms.Compose([transforms.ToTensor(), NormalizeFromDataset(dataset_cls=dataset_cls)])
+        dataset = dataset_cls(DATA_DIR, train=self.train, download=True, transform=transform)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=1024, shuffle=False, num_workers=4)
+        images_path, labels_path = self.get_data_paths()
+        images_path.parent.mkdir(exist_ok=True, parents=True)
+        images_shape = (len(dataset), *dataset[0][0].shape)
+        images = np.lib.format.open_memmap(images_path, mode='w+', dtype=np.float32, shape=images_shape)
+        labels = np.empty(len(dataset), dtype=np.int64)
+        position = 0
+        for images_batch, labels_batch in tqdm(loader, desc=f"Preprocessing {self.dataset_name}"):
+            images[position: position + len(labels_batch)] = images_batch.numpy()
+            labels[position: position + len(labels_batch)] = labels_batch.numpy()
+            position += len(labels_batch)
+        images.flush()
+        del images
+        # labels are written last: their presence marks a complete dataset
+        np.save(labels_path, labels)
+        print(f"Saved preprocessed data to {images_path.parent}")
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        return torch.from_numpy(np.array(self.images[index])), int(self.labels[index])
+
+
+class PackedSignsDataset(PreprocessedDataset):
+    """
+    Signs of the preprocessed images (the only thing the first binary layer sees), bit-packed into uint64 words
+    and viewed as bytes: 104 bytes per MNIST image. The whole set is kept in memory.
+    """
+
+    def __init__(self, dataset_name: str, train=True):
+        super().__init__(dataset_name, train=train)
+        signs_path = self.get_signs_path()
+        if not signs_path.exists():
+            self.pack(signs_path)
+        self.images = np.load(signs_path)
+
+    def get_signs_path(self) -> Path:
+        images_path, labels_path = self.get_data_paths()
+        return images_path.with_name(images_path.name.replace('_images', '_signs'))
+
+    def pack(self, signs_path: Path, chunk_size=4096):
+        signs = []
+        for start in range(0, len(self.images), chunk_size):
+            chunk = torch.from_numpy(np.array(self.images[start: start + chunk_size]))
+            signs.append(pack_signs_bytes(chunk.view(chunk.shape[0], -1)).numpy())
+        np.save(signs_path, np.concatenate(signs))
+
+    def __getitem__(self, index):
+        return torch.from_numpy(self.images[index]), int(self.labels[index])
+
+
+class MemmapLoader(object):
+    """
+    Yields batches of a PreprocessedDataset by slicing a (shuffled) index permutation.
+    No per-item transforms and no worker processes.
+    """
+
+    def __init__(self, dataset: PreprocessedDataset, batch_size=256, shuffle=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_workers = 0
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.permutation(len(self.dataset))
+        else:
+            order = np.arange(len(self.dataset))
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start: start + self.batch_size]
+            if self.shuffle:
+                # sorted indices read the memory-mapped file sequentially
+                indices = np.sort(indices)
+            images = torch.from_numpy(self.dataset.images[indices])
+            labels = torch.from_numpy(self.dataset.labels[indices])
+            yield images, labels
+
+
+class FullDataLoader(object):
+    """
+    Yields the whole dataset as a single batch, `steps_per_epoch` times per epoch.
+    """
+
+    def __init__(self, loader: torch.utils.data.DataLoader, steps_per_epoch: int = None):
+        """
+        :param loader: data loader to collect the samples from
+        :param steps_per_epoch: number of batches in epoch; defaults to the number of batches in the loader
+        """
+        self.dataset = loader.dataset
+        self.batch_size = loader.batch_size
+        self.num_workers = loader.num_workers
+        if steps_per_epoch is None:
+            steps_per_epoch = len(loader)
+        self.steps_per_epoch = steps_per_epoch
+        images, labels = [], []
+        for images_batch, labels_batch in loader:
+            images.append(images_batch)
+            labels.append(labels_batch)
+        self.images = torch.cat(images, dim=0)
+        self.labels = torch.cat(labels, dim=0)
+        if torch.cuda.is_available():
+            # the same device tensors are yielded at each step, so trainers can cache their outputs
+            self.images = self.images.cuda()
+            self.labels = self.labels.cuda()
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def __iter__(self):
+        for step in range(self.steps_per_epoch):
+            yield self.images, self.labels
+
+
+class ResidentLoader(object):
+    """
+    Evaluation set, kept in memory as one contiguous tensor and yielded in large fixed-size chunks
+    without shuffling. get_outputs() writes the model outputs into the preallocated `outputs` buffer.
+    """
+
+    def __init__(self, loader, chunk_size=4096):
+        """
+        :param loader: data loader to collect the samples from, without shuffling
+        :param chunk_size: number of samples per forward pass
+        """
+        self.dataset = loader.dataset
+        self.batch_size = chunk_size
+        self.num_workers = 0
+        if isinstance(self.dataset, PreprocessedDataset):
+            self.images = torch.from_numpy(np.array(self.dataset.images))
+            self.labels = torch.from_numpy(self.dataset.labels)
+        else:
+            images, labels = [], []
+            for images_batch, labels_batch in loader:
+                images.append(images_batch)
+                labels.append(labels_batch)
+            self.images = torch.cat(images, dim=0)
+            self.labels = torch.cat(labels, dim=0)
+        self.outputs = None
+
+    def cuda(self):
+        self.images = self.images.cuda()
+        self.labels = self.labels.cuda()
+        self.outputs = None
+        return self
+
+    def output_buffer(self, outputs_chunk: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        :param outputs_chunk: model outputs of the first chunk
+        :return: preallocated outputs buffer of the whole set, reused across calls
+        """
+        shape = (len(self.labels), *outputs_chunk.shape[1:])
+        if self.outputs is None or self.outputs.shape != shape or self.outputs.type() != outputs_chunk.type():
+            self.outputs = outputs_chunk.new(*shape)
+        return self.outputs
+
+    def __len__(self):
+        return math.ceil(len(self.labels) / self.batch_size)
+
+    def __iter__(self):
+        for start in range(0, len(self.labels), self.batch_size):
+            yield self.images[start: start + self.batch_size], self.labels[start: start + self.batch_size]
+
+
 def load_model_state(dataset_name: str, model_name: str):
     model_path = MODELS_DIR.joinpath(dataset_name, Path(model_name).with_suffix('.pt'))
     if not model_path.exists():
@@ -143,33 +356,41 @@ class AdamCustomDecay(torch.optim.Adam):
 class MNISTSmall(torch.utils.data.TensorDataset):
     def __init__(self, labels_keep=(5, 6), resize_to=(5, 5),  train=True):
         self.train = train
+        self.labels_keep = tuple(labels_keep)
+        self.resize_to = tuple(resize_to)
         data_path = self.get_data_path()
         if not data_path.exists():
-            mnist = datasets.MNIST(DATA_DIR, train=train, transform=transforms.Compose(
-                [transforms.Resize(size=resize_to),
-                 transforms.ToTensor()]
-            ))
-            self.process_mnist(mnist, labels_keep)
+            mnist = datasets.MNIST(DATA_DIR, train=train)
+            self.process_mnist(mnist, self.labels_keep)
         with open(data_path, 'rb') as f:
             data, targets = torch.load(f)
         super().__init__(data_tensor=data, target_tensor=targets)
 
     def get_data_path(self):
-        return Path('./data').joinpath(self.__class__.__name__, 'train.pt' if self.train else 'test.pt')
+        """
+        :return: cache path, unique for each labels_keep and resize_to combination
+        """
+        labels_str = '-'.join(map(str, self.labels_keep))
+        size_str = 'x'.join(map(str, self.resize_to))
+        return DATA_DIR.joinpath(self.__class__.__name__, f"labels_{labels_str}_size_{size_str}",
+                                 'train.pt' if self.train else 'test.pt')
 
     def process_mnist(self, mnist: torch.utils.data.Dataset, labels_keep: tuple):
-        data = []
-        targets = []
-        for image, label_old in tqdm(mnist, desc=f"Preparing {self.__class__.__name__} dataset"):
-            if label_old in labels_keep:
-                label_new = labels_keep.index(label_old)
-                targets.append(label_new)
-                data.append(image)
-        data = torch.cat(data, dim=0)
+        if mnist.train:
+            images, labels = mnist.train_data, mnist.train_labels
+        else:
+            images, labels = mnist.test_data, mnist.test_labels
+        label_map = torch.LongTensor(int(labels.max()) + 1).fill_(-1)
+        label_map.index_copy_(0, torch.LongTensor(labels_keep), torch.arange(0, len(labels_keep)).long())
+        targets = label_map.index_select(0, labels)
+        keep = (targets != -1).nonzero().view(-1)
+        targets = targets.index_select(0, keep)
+        images = images.index_select(0, keep).float().div_(255).unsqueeze(1)
+        data = F.adaptive_avg_pool2d(Variable(images, volatile=True), output_size=self.resize_to).data.squeeze(1)
         data_mean = data.mean(dim=0)
         data_std = data.std(dim=0)
+        data_std[data_std == 0] = 1  # normalized values will be zeros
         data = (data - data_mean) / data_std
-        targets = torch.LongTensor(targets)
         data_path = self.get_data_path()
         data_path.parent.mkdir(exist_ok=True, parents=True)
         with open(data_path, 'wb') as f: